@@ -1,39 +1,46 @@
+import argparse
+import select
 import sys
-import pickle
 import logging
-from bank import Bank
+import threading
 from decimal import *
 import datetime
-from transaction import Transaction, Base
-from account import OverdrawError
-from account import TransactionLimitError
-from account import TransactionSequenceError
-
-import sqlalchemy
-from sqlalchemy.orm.session import sessionmaker
+import json
+import time
+import banklog
+import metrics
+from errors import JournalInUseError
+from errors import OverdrawError
+from errors import TransactionLimitError
+from errors import TransactionSequenceError
 
 
 getcontext().rounding = ROUND_HALF_UP
 
-class BankCLI:
-    """Display a menu for bank and respond to choices when run."""
 
+def _import_models():
+    # SQLAlchemy and the models are most of the start-up time, so they are
+    # imported in the background while the first menu is up
+    import bank, db, group_commit, migrate
 
-    def __init__(self):
-        self._session = Session()
 
-        self._bank = self._session.query(Bank).first()
-        logging.basicConfig(filename= 'bank.log', level = logging.DEBUG, format='%(asctime)s|%(levelname)s|%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-        logging.debug("Loaded from bank.db")
-        if not self._bank:
-            self._bank = Bank()
-            self._session.add(self._bank)
-            self._session.commit()
-            logging.basicConfig(filename= 'bank.log', level = logging.DEBUG, format='%(asctime)s|%(levelname)s|%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-            logging.debug("Saved to bank.db")
+class BankCLI:
+    """Display a menu for bank and respond to choices when run."""
+
 
+    def __init__(self, url="sqlite:///bank.db", journal=None, max_ops=1, max_delay=1.0):
+        self._url = url
+        self._journal = journal
+        self._max_ops = max_ops
+        self._max_delay = max_delay
+        self._session = None
+        self._bank = None
+        self._writes = None
         self._selected_account = None
 
+        self._models = threading.Thread(target=_import_models, daemon=True)
+        self._models.start()
+
         self._choices = {
             "1": self._open_account,
             "2": self._summary,
@@ -43,6 +50,33 @@ class BankCLI:
             "6": self._interest_and_fees,
             "7": self._quit,
         }
+
+    def _connect(self):
+        """Open the database the first time a command needs it."""
+        if self._session is not None:
+            return
+        self._models.join()
+        from sqlalchemy.orm.session import sessionmaker
+        from bank import Bank
+        from group_commit import GroupCommitter
+        from migrate import prepare
+        import db
+
+        engine = db.create_engine(self._url, concurrent=True)
+        metrics.instrument(engine)
+        prepare(engine)
+        self._session = sessionmaker(bind=engine)()
+
+        self._bank = self._session.query(Bank).first()
+        logging.debug("Loaded from bank.db")
+        if not self._bank:
+            self._bank = Bank()
+            self._session.add(self._bank)
+            self._session.commit()
+            logging.debug("Saved to bank.db")
+
+        # commits every write unless started with --batch
+        self._writes = GroupCommitter(self._session, self._bank, self._journal, self._max_ops, self._max_delay)
         
     def _display_BankCLI(self):
         print(f"""--------------------------------
@@ -60,18 +94,38 @@ Enter command
         """Display the bank menu and respond to choices."""
         while True:
             self._display_BankCLI()
-            choice = input(">")
+            if self._writes is not None and not self._writes.pending:
+                # end the transaction so other tellers are not locked out while we wait
+                self._session.commit()
+            choice = self._input(">")
             action = self._choices.get(choice)
             if action:
+                if action != self._quit:
+                    self._connect()
                 action()
             else:
                 print("{0} is not a valid choice".format(choice))
 
+    def _input(self, prompt):
+        """input(), except that batched writes are still committed once
+        they are max_delay old while the teller is idle, since until then
+        they hold the database's write lock. Windows cannot wait on the
+        console with select, so there they are committed before waiting."""
+        print(prompt, end="", flush=True)
+        writes = self._writes
+        if writes is not None and writes.pending and sys.platform == "win32":
+            writes.flush()
+        while writes is not None and writes.pending:
+            writes.flush_if_due()
+            if writes.pending and select.select([sys.stdin], [], [], writes.due_in())[0]:
+                break
+        return input()
+
     def _open_account(self):
-        account_type = input("Type of account? (checking/savings)\n>")
+        account_type = self._input("Type of account? (checking/savings)\n>")
 
         while True:
-            amount = input("Initial deposit amount?\n>")
+            amount = self._input("Initial deposit amount?\n>")
             try:
                 amount = Decimal(amount)
             except InvalidOperation:
@@ -80,41 +134,41 @@ Enter command
 
             break
 
-        a = self._bank.new_account(account_type, self._session)
+        a = self._writes.write("open_account", account_type=account_type)
 
         try:
-            a.add_transaction(Decimal(amount), datetime.date.today(), self._session)
+            self._writes.write("add_transaction", account=a.get_id(), amount=amount, date=datetime.date.today())
         except OverdrawError:
             print("This transaction could not be completed due to an insufficient account balance.") 
-        
-        self._session.commit()
-        logging.basicConfig(filename= 'bank.log', level = logging.DEBUG, format='%(asctime)s|%(levelname)s|%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-        logging.debug("Saved to bank.db")
 
     def _summary(self, accounts=None):
-        if accounts is None:
-            accounts = self._bank.all_accounts()
-        for account in accounts:
-            print(account)
+        if accounts is not None:
+            for account in accounts:
+                print(account)
+            return
+
+        summaries = self._bank.summaries()
+        summaries.refresh(self._session)
+        for account_id in summaries.ids():
+            print(summaries.line(account_id))
 
     def _select_account(self):
-        account_id = input("Enter account number\n>")
+        account_id = self._input("Enter account number\n>")
 
-        self._selected_account = self._bank.find_account(account_id)
+        self._selected_account = self._bank.find_account(account_id, self._session)
 
         
 
     def _list_transactions(self):
         try:
-            sorted_transaction_list = self._selected_account.sort_transactions()
-            for transaction in sorted_transaction_list:
+            for transaction in self._selected_account.iter_transactions(self._session):
                 transaction.print_transaction()
         except AttributeError: 
             print("This command requires that you first select an account.")
 
     def _add_transactions(self):
         while True:
-            amount = input("Amount?\n>")
+            amount = self._input("Amount?\n>")
             try:
                 amount = Decimal(amount)
             except InvalidOperation:
@@ -124,7 +178,7 @@ Enter command
             break
 
         while True:
-            date = input("Date? (YYYY-MM-DD)\n>")
+            date = self._input("Date? (YYYY-MM-DD)\n>")
             try:
                 date = datetime.datetime.strptime(date, "%Y-%m-%d").date()
             except ValueError:
@@ -135,10 +189,7 @@ Enter command
 
 
         try:
-            self._selected_account.add_transaction(amount, date, self._session)
-            self._session.commit()
-            logging.basicConfig(filename= 'bank.log', level = logging.DEBUG, format='%(asctime)s|%(levelname)s|%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-            logging.debug("Saved to bank.db")
+            self._writes.write("add_transaction", account=self._selected_account.get_id(), amount=amount, date=date)
         except AttributeError: 
             print("This command requires that you first select an account.")
         except OverdrawError:
@@ -151,12 +202,8 @@ Enter command
 
     def _interest_and_fees(self):
         try:
-            self._selected_account.assess_interest_and_fees(self._session)
-            logging.basicConfig(filename= 'bank.log', level = logging.DEBUG, format='%(asctime)s|%(levelname)s|%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+            self._writes.write("assess_interest_and_fees", account=self._selected_account.get_id())
             logging.debug("Triggered fees and interest")
-            self._session.commit()
-            logging.basicConfig(filename= 'bank.log', level = logging.DEBUG, format='%(asctime)s|%(levelname)s|%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-            logging.debug("Saved to bank.db")
         except AttributeError: 
             print("This command requires that you first select an account.")
         except TransactionSequenceError as e:
@@ -175,19 +222,164 @@ Enter command
     #         logging.debug("Loaded from bank.pickle")
 
     def _quit(self):
+        if self._writes is not None:
+            self._writes.close()
         sys.exit(0)
 
+    def run_script(self, lines, out=sys.stdout):
+        """Run the commands in lines without prompting and write one JSON
+        result per command to out. Returns the number of commands run.
+
+        A command is a line such as "add -20.00 2024-01-31" or the same as
+        a JSON object, {"op": "add", "amount": "-20.00", "date": "2024-01-31"}.
+        The commands are open TYPE AMOUNT, select ID, add AMOUNT [DATE],
+        interest and summary; add and interest act on the selected account,
+        or on "account" in the JSON form. Blank lines and lines starting
+        with # are skipped. Writes are committed in groups as they go and
+        once more at the end. Results are held back until the writes
+        before them are committed, so nothing is reported as ok that an
+        error could still roll back."""
+        self._connect()
+        count = 0
+        results = []
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            count += 1
+            try:
+                command = _parse_command(line)
+                result = self._script_commands[command.pop("op")](self, **command)
+            except (OverdrawError, TransactionLimitError, TransactionSequenceError) as e:
+                result = {"ok": False, "error": type(e).__name__}
+            except (KeyError, TypeError, ValueError, ArithmeticError, LookupError) as e:
+                result = {"ok": False, "error": "invalid command", "message": str(e)}
+            result["ok"] = "error" not in result
+            result["line"] = number
+            results.append(json.dumps(result) + "\n")
+            if not self._writes.pending:
+                out.writelines(results)
+                results.clear()
+        self._writes.flush()
+        out.writelines(results)
+        return count
+
+    def _script_open(self, type, amount):
+        account = self._writes.write("open_account", account_type=type)
+        try:
+            self._writes.write("add_transaction", account=account.get_id(), amount=Decimal(amount), date=datetime.date.today())
+        except OverdrawError:
+            # the account stays open, as at the prompt
+            return {**self._script_result(account), "error": "OverdrawError"}
+        return self._script_result(account)
+
+    def _script_select(self, account):
+        self._selected_account = self._script_account(account)
+        return self._script_result(self._selected_account)
+
+    def _script_add(self, amount, date=None, account=None):
+        date = datetime.date.fromisoformat(date) if date else datetime.date.today()
+        account = self._script_account(account)
+        self._writes.write("add_transaction", account=account.get_id(), amount=Decimal(amount), date=date)
+        return self._script_result(account)
+
+    def _script_interest(self, account=None):
+        account = self._script_account(account)
+        self._writes.write("assess_interest_and_fees", account=account.get_id())
+        return self._script_result(account)
+
+    def _script_summary(self):
+        summaries = self._bank.summaries()
+        summaries.refresh(self._session)
+        return {"accounts": [{"account": i, "summary": summaries.line(i), "balance": f"{summaries.balance(i):.2f}"}
+                             for i in summaries.ids()]}
+
+    def _script_account(self, account_id):
+        if account_id is None:
+            if self._selected_account is None:
+                raise LookupError("no account selected")
+            return self._selected_account
+        account = self._bank.find_account(account_id, self._session)
+        if account is None:
+            raise LookupError(f"no account {account_id}")
+        return account
+
+    def _script_result(self, account):
+        return {"account": account.get_id(), "balance": f"{account._balance:.2f}"}
+
+    _script_commands = {
+        "open": _script_open,
+        "select": _script_select,
+        "add": _script_add,
+        "interest": _script_interest,
+        "summary": _script_summary,
+    }
+
+
+# positional arguments of each script command in its line form
+_SCRIPT_ARGUMENTS = {
+    "open": ["type", "amount"],
+    "select": ["account"],
+    "add": ["amount", "date"],
+    "interest": [],
+    "summary": [],
+}
+
+
+def _parse_command(line):
+    """Returns a script command line, in either form, as a dict with its op."""
+    if line.startswith("{"):
+        command = json.loads(line)
+        if not isinstance(command, dict):
+            raise ValueError("expected a JSON object")
+        return command
+    op, *values = line.split()
+    names = _SCRIPT_ARGUMENTS[op]
+    if len(values) > len(names):
+        raise ValueError(f"too many arguments for {op}")
+    return {"op": op, **dict(zip(names, values))}
 
-if __name__ == "__main__":
-    engine = sqlalchemy.create_engine(f"sqlite:///bank.db")
-    Base.metadata.create_all(engine)
 
-    Session = sessionmaker()
-    Session.configure(bind=engine)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Teller console for bank.db.")
+    parser.add_argument("--batch", type=int, metavar="N",
+                        help="commit writes in groups of up to N, journaling each one until then")
+    parser.add_argument("--max-delay", type=float, default=1.0,
+                        help="seconds a batched write may wait for its commit")
+    parser.add_argument("--journal", metavar="FILE",
+                        help="the teller's own journal file, needed with --batch")
+    parser.add_argument("--script", metavar="FILE",
+                        help="run the commands in FILE (- for stdin) and print JSON results; "
+                             "writes are committed every --batch of them (default 1000), unjournaled")
+    parser.add_argument("--profile", nargs="?", const="bank-metrics.json", metavar="FILE",
+                        help="record operation, SQL, commit and fsync latencies and dump them to FILE "
+                             "(default bank-metrics.json; a .prom file gets the Prometheus text format)")
+    parser.add_argument("--profile-interval", type=float, default=10.0, metavar="SECONDS",
+                        help="how often the --profile dump is rewritten")
+    args = parser.parse_args()
+    if args.batch and not args.script and not args.journal:
+        parser.error("--batch needs a --journal file of this teller's own")
+
+    banklog.configure()
+    if args.profile:
+        metrics.configure(args.profile, args.profile_interval)
+
+    if args.script:
+        cli = BankCLI("sqlite:///bank.db", None, args.batch or 1000, float("inf"))
+        start = time.perf_counter()
+        with (sys.stdin if args.script == "-" else open(args.script)) as f:
+            count = cli.run_script(f)
+        elapsed = time.perf_counter() - start
+        print(f"{count} commands in {elapsed:.2f} s, {count / elapsed:.0f}/s", file=sys.stderr)
+        sys.exit(0)
 
     try:
-        BankCLI().run()
+        if args.batch:
+            BankCLI("sqlite:///bank.db", args.journal, args.batch, args.max_delay).run()
+        else:
+            BankCLI().run()
+    except JournalInUseError as e:
+        sys.exit(str(e))
     except Exception as e:
         print("Sorry! Something unexpected happened. If this problem persists please contact our support team for assistance.")
-        logging.basicConfig(filename= 'bank.log', level = logging.DEBUG, format='%(asctime)s|%(levelname)s|%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-        logging.error(type(e).__name__ + ": " + repr(str(e)))
+        logging.error("%s: %r", type(e).__name__, str(e))
@@ -1,19 +1,64 @@
 import tkinter as tk
 from tkinter import messagebox
 from bank import Bank
+from account import Account
 import logging
-from transaction import Base
+from transaction import Transaction
+from migrate import prepare
+import banklog
+import db
 from decimal import *
 import datetime
-from account import OverdrawError
-from account import TransactionLimitError
-from account import TransactionSequenceError
-from tkcalendar import DateEntry
+from errors import OverdrawError
+from errors import TransactionLimitError
+from errors import TransactionSequenceError
+from virtual_list import PageLoader, VirtualList
 import sys
 
-import sqlalchemy
+from sqlalchemy import func, tuple_
 from sqlalchemy.orm.session import sessionmaker
 
+
+class _AccountRows:
+    """VirtualList source: the bank's accounts in id order."""
+
+    def __init__(self, bank_id):
+        self._bank_id = bank_id
+
+    def count(self, session):
+        return session.query(func.count(Account._id)).filter(Account._bank_id == self._bank_id).scalar()
+
+    def page(self, session, offset, after, limit):
+        query = session.query(Account).filter(Account._bank_id == self._bank_id).order_by(Account._id)
+        if after is not None:
+            query = query.filter(Account._id > after)
+        else:
+            query = query.offset(offset)
+        return [(account.get_id(), str(account), None) for account in query.limit(limit)]
+
+
+class _TransactionRows:
+    """VirtualList source: an account's transactions ordered by date,
+    read along the (account, date) index."""
+
+    def __init__(self, account_id):
+        self._account_id = account_id
+
+    def count(self, session):
+        return session.query(func.count(Transaction._id)).filter(Transaction._account_id == self._account_id).scalar()
+
+    def page(self, session, offset, after, limit):
+        query = session.query(Transaction).filter(Transaction._account_id == self._account_id).order_by(
+            Transaction._creation_date, Transaction._id)
+        if after is not None:
+            query = query.filter(tuple_(Transaction._creation_date, Transaction._id) > tuple_(*after))
+        else:
+            query = query.offset(offset)
+        #use get amount to change color of transaction
+        return [((t._creation_date, t._id), str(t), "green" if t.get_amt() > 0 else "red")
+                for t in query.limit(limit)]
+
+
 class BankGUI:
     """Display a menu and respond to choices when run"""
 
@@ -21,13 +66,11 @@ class BankGUI:
         self._session = Session()
 
         self._bank = self._session.query(Bank).first()
-        logging.basicConfig(filename= 'bank.log', level = logging.DEBUG, format='%(asctime)s|%(levelname)s|%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
         logging.debug("Loaded from bank.db")
         if not self._bank:
             self._bank = Bank()
             self._session.add(self._bank)
             self._session.commit()
-            logging.basicConfig(filename= 'bank.log', level = logging.DEBUG, format='%(asctime)s|%(levelname)s|%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
             logging.debug("Saved to bank.db")
 
         self._window = tk.Tk()
@@ -35,12 +78,11 @@ class BankGUI:
 
         def handle_exception(exception, value, traceback):
             messagebox.showwarning(message="Sorry! Something unexpected happened. If this problem persists please contact our support team for assistance.")
-            logging.error(f"{exception.__name__}: {repr(value)}")
+            logging.error("%s: %r", exception.__name__, value)
             sys.exit(1)
 
         self._window.report_callback_exception = handle_exception
 
-        self._bank = Bank()
         self._options_frame = tk.Frame(self._window)
 
         tk.Button(self._options_frame,
@@ -63,12 +105,17 @@ class BankGUI:
         self._account_frame.grid(row=2, column=1)
         self._transactions_frame.grid(row = 2, column = 2)
 
-        self._list_box = None
+        # both lists only hold the rows in view and load pages on a
+        # background thread with its own session
+        loader = PageLoader(self._window, Session)
+        self._accounts_list = VirtualList(self._account_frame, loader, command=self._account_selected)
+        self._accounts_list.pack()
+        self._transactions_list = VirtualList(self._transactions_frame, loader)
+        self._shown_bank = None
         self._select_account = None
         self._input_flag = 1
 
-        self.var=tk.IntVar()
-        
+        self._display_accounts()
         self._window.mainloop()
     
 
@@ -90,22 +137,28 @@ class BankGUI:
                 messagebox.showwarning(message="Please try again with a valid dollar amount.")
                 return
 
+            db.begin_write(self._session)
             account = self._bank.new_account(variable.get(), self._session)
+            overdrawn = False
             try:
                 account.add_transaction(Decimal(e1.get()), datetime.date.today(), self._session)
             except OverdrawError:
-                messagebox.showwarning(message="This transaction could not be completed due to an insufficient account balance.")
+                overdrawn = True
 
             e1.destroy()
             b.destroy()
             l1.destroy()
             c.destroy()
 
-            self._display_accounts()
-
             self._session.commit()
-            logging.basicConfig(filename= 'bank.log', level = logging.DEBUG, format='%(asctime)s|%(levelname)s|%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
             logging.debug("Saved to bank.db")
+
+            # warn only once the account is committed, so the database is
+            # not locked while the warning is on screen
+            if overdrawn:
+                messagebox.showwarning(message="This transaction could not be completed due to an insufficient account balance.")
+
+            self._display_accounts()
         
 
 
@@ -127,40 +180,26 @@ class BankGUI:
 
     def _display_accounts(self):
         """Displays all accounts in the bank"""
-        def callback():
-            selected_account = self._bank.find_account(self.var.get())
-            self._display_transactions(selected_account)
-            self._select_account = selected_account
-        
+        # only the accounts whose summary changed are redrawn
+        summaries = self._bank.summaries()
+        changed = summaries.refresh(self._session, load_all=False)
+        if self._shown_bank != self._bank._id:
+            self._shown_bank = self._bank._id
+            self._accounts_list.show(_AccountRows(self._shown_bank))
+        else:
+            self._accounts_list.update_rows([(i, summaries.line(i), None) for i in changed])
+        self._session.commit()
+
+    def _account_selected(self, account_id):
+        self._select_account = self._bank.find_account(account_id, self._session)
+        self._session.commit()
+        self._display_transactions(self._select_account)
 
-        account_buttons = []
-        row = 0
-        for account in self._bank.all_accounts():
-            account_buttons.append(tk.Radiobutton(self._account_frame, text=account, variable=self.var, value=account.get_id(), command=callback).grid(row=row, column=1))
-            row += 1
-    
     def _display_transactions(self, account):
         """Displays the transactions of an account"""
-        if self._list_box:
-            self._list_box.delete(0,tk.END)
-        
-        else:
-            self._list_box = tk.Listbox(self._transactions_frame)
-            
-        row = 1
-        sorted_transaction_list = account.sort_transactions()
-        for transaction in sorted_transaction_list:
-            self._list_box.insert(row, transaction)
-
-            #use get amount to change color of transaction
-            if transaction.get_amt() > 0:
-                self._list_box.itemconfig(row-1, {'fg':'green'})
-            else:
-                self._list_box.itemconfig(row-1, {'fg':'red'})
-            
-            row +=1
-        
-        self._list_box.pack()
+        if self._transactions_list.winfo_manager() == "":
+            self._transactions_list.pack()
+        self._transactions_list.show(_TransactionRows(account.get_id()))
 
     def _add_transaction(self):
         """Adds a new transaction to an account"""
@@ -169,20 +208,29 @@ class BankGUI:
                 messagebox.showwarning(message="Please try again with a valid dollar amount.")
                 return
             try:
+                db.begin_write(self._session)
                 self._select_account.add_transaction(Decimal(e1.get()), cal.get_date(), self._session)
+                self._session.commit()
+                logging.debug("Saved to bank.db")
                 self._display_accounts()
-                self._display_transactions(self._select_account)
+                self._transactions_list.reload()
                 e1.destroy()
                 cal.destroy()
                 b.destroy()
                 l1.destroy()
+            # end the rejected write's transaction before the warning goes
+            # up, so the database is not locked while it is on screen
             except AttributeError: 
+                self._session.rollback()
                 messagebox.showwarning(message="This command requires that you first select an account.")
             except OverdrawError:
+                self._session.rollback()
                 messagebox.showwarning(message="This transaction could not be completed due to an insufficient account balance.")
             except TransactionLimitError:
+                self._session.rollback()
                 messagebox.showwarning(message="This transaction could not be completed because the account has reached a transaction limit.")
             except TransactionSequenceError as e:
+                self._session.rollback()
                 messagebox.showwarning(message="New transactions must be from " + str(e.latest_date) +  " onward.")
 
         l1 = tk.Label(self._options_frame, text="Amount:")
@@ -192,6 +240,8 @@ class BankGUI:
         e1.grid(row=5, column=4)
 
 
+        # tkcalendar is only needed here, so it is not imported at start-up
+        from tkcalendar import DateEntry
         cal = DateEntry(self._options_frame,selectmode='day',year=2023,month=1,day=1)
         cal.grid(row=6, column = 4)
 
@@ -201,18 +251,24 @@ class BankGUI:
     def _interest_and_fees(self):
         """Assesses the interest and fees to an account"""
         try:
+            db.begin_write(self._session)
             self._select_account.assess_interest_and_fees(self._session)
+            self._session.commit()
+            logging.debug("Saved to bank.db")
             self._display_accounts()
-            self._display_transactions(self._select_account)
+            self._transactions_list.reload()
         except AttributeError: 
+            self._session.rollback()
             messagebox.showwarning(message="This command requires that you first select an account.")
         except TransactionSequenceError as e:
+            self._session.rollback()
             messagebox.showwarning(message="Cannot apply interest and fees again in the month of " + str(e.latest_date.strftime("%B")) + ".")
         
 
 if __name__ == "__main__":
-    engine = sqlalchemy.create_engine(f"sqlite:///bank.db")
-    Base.metadata.create_all(engine)
+    banklog.configure()
+    engine = db.create_engine(f"sqlite:///bank.db", concurrent=True)
+    prepare(engine)
 
     Session = sessionmaker()
     Session.configure(bind=engine)
@@ -3,40 +3,40 @@ from decimal import *
 import datetime
 import calendar
 import logging
+from collections import Counter
 
-from sqlalchemy import Column, Integer, String, ForeignKey, DATE, Float
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import Column, Integer, String, ForeignKey, DATE, Index, tuple_, inspect, func, select, bindparam
+from sqlalchemy.orm import relationship, backref, object_session
+from sqlalchemy.orm.attributes import set_committed_value
 
-getcontext().rounding = ROUND_HALF_UP
-
-class OverdrawError(Exception):
-    pass
+from money import FixedPoint, cents
+import metrics
+from errors import OverdrawError, TransactionLimitError, TransactionSequenceError
 
-class TransactionLimitError(Exception):
-    pass
-    
-
-class TransactionSequenceError(Exception):
-    def __init__(self, date):
-        self.latest_date = date
+getcontext().rounding = ROUND_HALF_UP
 
 class Account(Base):
 
-    last_id = 0
-
     __tablename__ = "account"
 
+    # ids are never reused, and IdAllocator reserves blocks of them
+    # from the same sqlite_sequence counter
+    __table_args__ = (
+        Index("ix_account_bank", "_bank_id"),
+        {"sqlite_autoincrement": True},
+    )
+
     _id = Column(Integer, primary_key=True)
     _bank_id = Column(Integer, ForeignKey("bank._id"))
 
     _transactions = relationship("Transaction", backref=backref("account"))
 
-    _balance = Column(Float(asdecimal=True))
+    _balance = Column(FixedPoint(2))
 
     #_balance = Column(String)
     latest_date = Column(DATE)
 
-    _interest_rate = Column(Float(asdecimal=True))
+    _interest_rate = Column(FixedPoint(6))
 
     #name = Column(String(50))
     type = Column(String(20))
@@ -50,20 +50,13 @@ class Account(Base):
 
     def __init__(self):
         """initialize an account with a list of transactions and 
-        a balance of the total amount. Automatically set the account's
-        unique id."""
+        a balance of the total amount. The account's unique id is
+        assigned by the database when it is first flushed."""
 
         # create list for transactions and add inital transaction
         #self._transactions = []
         self._balance = Decimal(0)
         self.latest_date = datetime.date.today()
-
-        # give account id and update static variable
-        Account.last_id += 1
-        self._id = Account.last_id
-
-        logging.basicConfig(filename= 'bank.log', level = logging.DEBUG, format='%(asctime)s|%(levelname)s|%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-        logging.debug(f"Created account: {self._id}")
     
     def id_matches(self, id):
         """
@@ -75,39 +68,115 @@ class Account(Base):
         """Returns the accounts id"""
         return self._id
     
+    @metrics.timed("add_transaction")
     def add_transaction(self, amount, date, session):
         """Checks a pending transaction to see if it is allowed and adds it to the account if it is.
         """
+        amount = cents(amount)
+        self.check_transaction(amount, date)
+
+        if inspect(self).persistent:
+            self._update_row(amount, date, session)
+        else:
+            self.apply_transaction(amount, date)
+        t = Transaction(amount, date, 0, self._balance)
+        t.account = self
+        session.add(t)
+        self._changed()
+
+        logging.debug("Created transaction: %s, %s", self._id, amount)
+
+    def _changed(self):
+        """Invalidates this account's entry in its bank's summary cache."""
+        bank = self.bank
+        if bank is not None and bank._summaries is not None:
+            bank._summaries.invalidate(self._id)
+
+    def check_transaction(self, amount, date):
+        """Raises the error add_transaction would raise if a pending
+        transaction is not allowed on this account."""
         if amount >= 0 or self._balance > abs(amount):
             limits_ok = self._check_limits(amount, date)
             if limits_ok:
-                if date >= self.latest_date:
-                    self._balance += amount
-                    t = Transaction(amount, date)
-                    self._transactions.append(t)
-                    str(t._amount)
-                    session.add(t)
-                    self.latest_date = date
-
-                    logging.basicConfig(filename= 'bank.log', level = logging.DEBUG, format='%(asctime)s|%(levelname)s|%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-                    logging.debug(f"Created transaction: {self._id}, {amount}")
-                else:
+                if date < self.latest_date:
                     raise(TransactionSequenceError(self.latest_date))
             else:
                 raise(TransactionLimitError)
         else:
             raise(OverdrawError)
 
-    
+    def apply_transaction(self, amount, date):
+        """Updates the balance and latest date for an accepted transaction."""
+        self._balance += amount
+        self.latest_date = date
+
+    def _update_row(self, amount, date, session):
+        """Applies an accepted transaction to the stored account with one
+        conditional UPDATE, so a writer in another process can neither have
+        overdrawn the account nor moved its latest date in the meantime."""
+        session.flush()
+        table = Account.__table__
+        allowed = [table.c._id == self._id, table.c.latest_date <= date]
+        if amount < 0:
+            allowed.append(table.c._balance > -amount)
+        update = table.update().where(*allowed).values(
+            _balance=table.c._balance + amount, latest_date=date)
+        balance = session.execute(update.returning(table.c._balance)).scalar()
+
+        if balance is None:
+            # the stored account has changed; report what stops it now
+            session.refresh(self)
+            self.check_transaction(amount, date)
+            raise(OverdrawError)
+        set_committed_value(self, "_balance", balance)
+        set_committed_value(self, "latest_date", date)
+
     def _check_limits(self, amount, date):
         return True
+
+    def _count_unsaved(self, date):
+        pass
+
+    def _saved(self):
+        pass
     
     def sort_transactions(self):
         """
         Sort the transactions by date
         """
         return sorted(self._transactions)
+
+    def balance_as_of(self, date, session):
+        """Returns the balance at the end of the given date, read from the
+        running balance of the last transaction on or before it."""
+        balance = session.query(Transaction._balance_after).filter(
+            Transaction._account_id == self._id,
+            Transaction._creation_date <= date).order_by(
+            Transaction._creation_date.desc(), Transaction._id.desc()).limit(1).scalar()
+        return balance if balance is not None else Decimal(0)
+
+    def transactions_page(self, session, after=None, limit=500):
+        """Returns up to limit transactions ordered by date from the database,
+        starting after the transaction after (the last one of the previous page).
+        Pages are found through the (account, date) index, so nothing
+        before the page is loaded."""
+        query = session.query(Transaction).filter(Transaction._account_id == self._id)
+        if after is not None:
+            query = query.filter(tuple_(Transaction._creation_date, Transaction._id)
+                                 > tuple_(after._creation_date, after._id))
+        query = query.order_by(Transaction._creation_date, Transaction._id)
+        return query.limit(limit).all()
+
+    def iter_transactions(self, session, page_size=500):
+        """Yields the transactions ordered by date, one page at a time."""
+        page = self.transactions_page(session, None, page_size)
+        while page:
+            yield from page
+            if len(page) < page_size:
+                break
+            page = self.transactions_page(session, page[-1], page_size)
     
+    @metrics.timed("assess_interest_and_fees")
     def assess_interest_and_fees(self, session):
         """Calculates interest for an account balance and adds it as a new transaction exempt from limits. 
             Also checks if fees apply.
@@ -115,23 +184,31 @@ class Account(Base):
         month_range = calendar.monthrange(self.latest_date.year, self.latest_date.month)
         date = datetime.datetime(self.latest_date.year, self.latest_date.month, month_range[1]).date()
 
-        for t in self._transactions:
-            if t.check_flag_and_date(date):
-                raise(TransactionSequenceError(self.latest_date))
+        if self.interest_applied(date, session):
+            raise(TransactionSequenceError(self.latest_date))
 
-        amount = self._balance * self._interest_rate
+        amount = cents(self._balance * self._interest_rate)
 
         self.latest_date = date
         self._balance += amount
-        t = Transaction(amount, date, 1)
-        self._transactions.append(t)
+        t = Transaction(amount, date, 1, self._balance)
+        t.account = self
         session.add(t)
+        self._changed()
 
-        logging.basicConfig(filename= 'bank.log', level = logging.DEBUG, format='%(asctime)s|%(levelname)s|%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-        logging.debug(f"Created transaction: {self._id}, {amount}")
+        logging.debug("Created transaction: %s, %s", self._id, amount)
 
         self._fees(date, session)
 
+    def interest_applied(self, date, session):
+        """Check if interest has already been applied for the month ending on date.
+        Uses the (account, date) index rather than loading the transactions."""
+        query = session.query(Transaction._id).filter(
+            Transaction._account_id == self._id,
+            Transaction._creation_date == date,
+            Transaction._interest_flag == 1)
+        return query.first() is not None
+
     def _fees(self, date, session):
         pass
 
@@ -151,6 +228,10 @@ class CheckingAccount(Account):
         'polymorphic_identity':'Checking',
     }
 
+    # a fee of _low_balance_fee is charged at month end below _low_balance
+    _low_balance = Decimal(100)
+    _low_balance_fee = Decimal(-10)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._interest_rate = Decimal("0.0012")
@@ -164,13 +245,22 @@ class CheckingAccount(Account):
     def _fees(self, date, session):
         """Adds a low balance fee if balance is below a particular threshold. Fee amount and balance threshold are defined on the CheckingAccount.
         """
-        if self._balance < 100:
-            self._balance += -10
-            t = Transaction(-10, date, 1)
-            self._transactions.append(t)
+        if self._balance < self._low_balance:
+            self._balance += self._low_balance_fee
+            t = Transaction(self._low_balance_fee, date, 1, self._balance)
+            t.account = self
             session.add(t)
-            logging.basicConfig(filename= 'bank.log', level = logging.DEBUG, format='%(asctime)s|%(levelname)s|%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-            logging.debug(f"Created transaction: {self._id}, -10")
+            self._changed()
+            logging.debug("Created transaction: %s, %s", self._id, self._low_balance_fee)
+
+
+# the non-interest transactions of an account on a day and in the month
+# around it, built once since building the statement costs more than running it
+_LIMIT_COUNTS = select(
+    func.count().filter(Transaction._creation_date == bindparam("date")), func.count()).where(
+    Transaction._account_id == bindparam("account"),
+    Transaction._interest_flag == 0,
+    Transaction._creation_date.between(bindparam("first"), bindparam("last")))
 
 
 class SavingsAccount(Account):
@@ -189,17 +279,41 @@ class SavingsAccount(Account):
         """ 
         return "Savings" + super().__str__()
     
+    # per-day counts of the transactions Bank.import_transactions has
+    # accepted but not inserted yet, which the database cannot count
+    _unsaved = None
+
+    @metrics.timed("check_limits")
     def _check_limits(self, amount, date):
-        """ Check if the daily or monthly limit has been reached. """
-        day_counter = 0
-        month_counter = 0
-        for transaction in self._transactions:
-            if transaction.check_day_limit(date):
-                day_counter += 1
-            if transaction.check_month_limit(date):
-                month_counter += 1
+        """ Check if the daily or monthly limit has been reached.
+        The stored non-interest transactions of the day and the month are
+        counted in the database on every check, from the (account, date)
+        index, so writes made by other processes are always counted."""
+        first = date.replace(day=1)
+        last = date.replace(day=calendar.monthrange(date.year, date.month)[1])
+        day_counter = month_counter = 0
+        session = object_session(self)
+        if session is not None:
+            if self._id is None:
+                session.flush()
+            day_counter, month_counter = session.execute(_LIMIT_COUNTS, {
+                "account": self._id, "date": date, "first": first, "last": last}).one()
+        if self._unsaved:
+            day_counter += self._unsaved[date]
+            month_counter += sum(count for day, count in self._unsaved.items()
+                                 if first <= day <= last)
 
         if day_counter < 2 and month_counter < 5:
             return True
         else:
-            return False
\ No newline at end of file
+            return False
+
+    def _count_unsaved(self, date):
+        """Count an accepted transaction whose row is not inserted yet."""
+        if self._unsaved is None:
+            self._unsaved = Counter()
+        self._unsaved[date] += 1
+
+    def _saved(self):
+        """The rows _count_unsaved counted have been inserted."""
+        self._unsaved = None
@@ -0,0 +1,157 @@
+"""An asyncio front end to the bank, for running it behind a network service.
+
+    bank = await AsyncBank.open("sqlite+aiosqlite:///bank.db")
+    account_id = await bank.open_account("checking", Decimal("100"))
+    await bank.add_transaction(account_id, Decimal("-20"), datetime.date.today())
+    await bank.close()
+
+It needs the aiosqlite driver. Every write is queued to a single writer
+task, which applies all the writes waiting at that moment in one session,
+each inside its own SAVEPOINT, and commits them together. Concurrent
+clients therefore share commits (group commit), while a write that fails
+with OverdrawError and the like only rolls back itself. A write's
+coroutine returns, or raises that error, once its batch is committed.
+Reads run on their own connections and do not wait for the writer.
+"""
+
+import asyncio
+import datetime
+
+import sqlalchemy
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from bank import Bank
+from migrate import prepare
+import db
+
+
+class AccountNotFoundError(LookupError):
+    pass
+
+
+class AsyncBank:
+    """Coroutine versions of the bank operations. Create it with open()."""
+
+    def __init__(self, write_engine, read_engine, bank_id, max_batch=256, max_delay=0):
+        self._write_engine = write_engine
+        self._read_engine = read_engine
+        self._bank_id = bank_id
+        self._max_batch = max_batch
+        self._max_delay = max_delay
+        self._queue = asyncio.Queue()
+        self._reads = async_sessionmaker(read_engine, expire_on_commit=False)
+        self._writer = asyncio.create_task(self._write_loop())
+
+    @classmethod
+    async def open(cls, url="sqlite+aiosqlite:///bank.db", max_batch=256, max_delay=0):
+        """Create or migrate the database at url and start the writer.
+
+        max_batch caps the writes committed together; max_delay is how long
+        the writer lingers for more writes before committing a batch."""
+        engine = sqlalchemy.create_engine(sqlalchemy.make_url(url).set(drivername="sqlite"))
+        prepare(engine)
+        engine.dispose()
+
+        write_engine = create_async_engine(url)
+        db.configure_concurrent(write_engine.sync_engine, immediate=True)
+        read_engine = create_async_engine(url)
+
+        async with async_sessionmaker(write_engine, expire_on_commit=False)() as session:
+            bank = (await session.execute(sqlalchemy.select(Bank))).scalars().first()
+            if not bank:
+                bank = Bank()
+                session.add(bank)
+                await session.commit()
+            bank_id = bank._id
+        return cls(write_engine, read_engine, bank_id, max_batch, max_delay)
+
+    async def close(self):
+        """Finish the queued writes and close the database connections."""
+        await self._queue.put(None)
+        await self._writer
+        await self._write_engine.dispose()
+        await self._read_engine.dispose()
+
+    async def open_account(self, account_type, amount):
+        """Open a checking or savings account with an initial deposit and
+        return its id."""
+        def write(session):
+            account = session.get(Bank, self._bank_id).new_account(account_type, session)
+            account.add_transaction(amount, datetime.date.today(), session)
+            return account.get_id()
+        return await self._write(write)
+
+    async def add_transaction(self, account_id, amount, date):
+        def write(session):
+            self._find(account_id, session).add_transaction(amount, date, session)
+        await self._write(write)
+
+    async def assess_interest_and_fees(self, account_id):
+        def write(session):
+            self._find(account_id, session).assess_interest_and_fees(session)
+        await self._write(write)
+
+    async def list_transactions(self, account_id, after=None, limit=500):
+        """Returns a page of the account's transactions ordered by date,
+        as for Account.transactions_page."""
+        def read(session):
+            return self._find(account_id, session).transactions_page(session, after, limit)
+        async with self._reads() as session:
+            return await session.run_sync(read)
+
+    def _find(self, account_id, session):
+        account = session.get(Bank, self._bank_id).find_account(account_id, session)
+        if account is None:
+            raise AccountNotFoundError(account_id)
+        return account
+
+    async def _write(self, write):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((write, future))
+        return await future
+
+    async def _write_loop(self):
+        session = async_sessionmaker(self._write_engine)()
+        try:
+            while True:
+                batch = [await self._queue.get()]
+                if self._max_delay:
+                    await asyncio.sleep(self._max_delay)
+                while len(batch) < self._max_batch and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+
+                stop = None in batch
+                batch = [write for write in batch if write is not None]
+                if batch:
+                    await self._commit(session, batch)
+                if stop:
+                    return
+        finally:
+            await session.close()
+
+    async def _commit(self, session, batch):
+        """Apply a batch of writes and commit them together."""
+        def apply(sync_session):
+            results = []
+            for write, _ in batch:
+                try:
+                    with sync_session.begin_nested():
+                        results.append((write(sync_session), None))
+                except Exception as e:
+                    results.append((None, e))
+            sync_session.commit()
+            return results
+
+        try:
+            results = await session.run_sync(apply)
+        except Exception as e:
+            await session.rollback()
+            results = [(None, e)] * len(batch)
+
+        for (_, future), (result, error) in zip(batch, results):
+            if future.cancelled():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
@@ -1,13 +1,42 @@
+from account import Account
 from account import CheckingAccount
 from account import SavingsAccount
+from account import OverdrawError
+from account import TransactionLimitError
+from account import TransactionSequenceError
 from decimal import *
-from transaction import Base
+from transaction import Transaction, Base
+from money import cents
+from summary import SummaryCache
+import db
+import metrics
+import datetime
+import logging
 
 from sqlalchemy import Column, Integer
 from sqlalchemy.orm import relationship, backref
 
 getcontext().rounding = ROUND_HALF_UP
 
+
+class ImportReport:
+    """Outcome of Bank.import_transactions. Rows are numbered from 1 and
+    every row not listed in rejected was accepted."""
+
+    def __init__(self):
+        self.accepted = 0
+        self.rejected = []
+
+    def accept(self):
+        self.accepted += 1
+
+    def reject(self, row, reason):
+        self.rejected.append((row, reason))
+
+    def __str__(self):
+        return f"accepted: {self.accepted}, rejected: {len(self.rejected)}"
+
+
 class Bank(Base):
     """Represent a collection of accounts that can be opened,
     add new transactions, and be searched."""
@@ -17,27 +46,164 @@ class Bank(Base):
     _id = Column(Integer, primary_key=True)
 
     _accounts = relationship("Account", backref=backref("bank"))
+
+    # id -> account index, built from _accounts the first time it is needed
+    _index = None
+
+    # summary lines of the accounts, see summaries()
+    _summaries = None
     
-    def new_account(self, account_type, session):
-        """Create a new bank account and add it to the list."""
+    def new_account(self, account_type, session, ids=None):
+        """Create a new bank account and add it to the list.
+
+        The id comes from the database: from an IdAllocator block if ids
+        is given, otherwise by flushing the account right away."""
         if account_type == "checking":
             account = CheckingAccount()
         else:
             account = SavingsAccount()
-        
-        self._accounts.append(account)
+
+        if ids is not None:
+            account._id = ids.next_id()
+        account.bank = self
         session.add(account)
+        if ids is None:
+            session.flush()
+        logging.debug("Created account: %s", account.get_id())
+
+        if self._index is not None:
+            self._index[account.get_id()] = account
+        if self._summaries is not None:
+            self._summaries.invalidate(account.get_id())
         return account
     
+    def summaries(self):
+        """Returns the bank's SummaryCache, creating it on first use."""
+        if self._summaries is None:
+            self._summaries = SummaryCache(self)
+        return self._summaries
+
     def all_accounts(self):
         """Returns all accounts in the bank"""
 
         return self._accounts
     
-    def find_account(self, account_id):
-        """Locate the account with the given id."""
-        for account in self._accounts:
-            if account.id_matches(account_id):
+    @metrics.timed("find_account")
+    def find_account(self, account_id, session=None):
+        """Locate the account with the given id.
+
+        With a session the account is fetched by primary key, so the
+        _accounts collection never has to be loaded. Without one, an
+        in-memory id index over _accounts is used."""
+        account_id = int(account_id)
+        if session is not None:
+            account = session.get(Account, account_id)
+            if account is not None and account.bank is self:
                 return account
-        return None
-        
\ No newline at end of file
+            return None
+        return self._account_index().get(account_id)
+
+    def _account_index(self):
+        """Returns the id -> account index, building it on first use."""
+        if self._index is None:
+            self._index = {account.get_id(): account for account in self._accounts}
+        return self._index
+
+    def balances_as_of(self, date, session):
+        """Returns the balance of every account at the end of the given date
+        as a dict keyed by account id, in a single query."""
+        balance = session.query(Transaction._balance_after).filter(
+            Transaction._account_id == Account._id,
+            Transaction._creation_date <= date).order_by(
+            Transaction._creation_date.desc(), Transaction._id.desc()).limit(1)
+        balance = balance.correlate(Account).scalar_subquery()
+        rows = session.query(Account._id, balance).filter(Account._bank_id == self._id)
+        return {account_id: amount if amount is not None else Decimal(0)
+                for account_id, amount in rows}
+
+    def import_transactions(self, rows, session, chunk_size=10000):
+        """Add (account_id, amount, date) rows in bulk.
+
+        Each row gets the same overdraw, limit and sequence checks as
+        Account.add_transaction. Accepted rows are written with one bulk
+        insert and one commit per chunk_size rows. Each chunk is one write
+        transaction, begun with db.begin_write before its first row is
+        checked, so the balances it checks against cannot change under it.
+        Amounts and dates may be given as strings, e.g. straight from a
+        CSV file."""
+        report = ImportReport()
+        pending = []
+        touched = set()
+        accounts = {}
+
+        # the accounts expire at each commit, so every chunk reloads them
+        # under its own write lock and sees what other writers committed
+        with session.no_autoflush:
+            for row, (account_id, amount, date) in enumerate(rows, 1):
+                if not pending:
+                    db.begin_write(session)
+                try:
+                    account_id = int(account_id)
+                    amount = cents(Decimal(amount))
+                    if not isinstance(date, datetime.date):
+                        date = datetime.date.fromisoformat(date)
+                except (ValueError, TypeError, InvalidOperation):
+                    report.reject(row, "invalid")
+                    continue
+                if not amount.is_finite():
+                    # NaN gets through cents, but no comparison takes it
+                    report.reject(row, "invalid")
+                    continue
+
+                account = accounts.get(account_id)
+                if account is None:
+                    account = accounts[account_id] = self.find_account(account_id, session)
+                if account is None:
+                    report.reject(row, "unknown account")
+                    continue
+
+                try:
+                    account.check_transaction(amount, date)
+                except OverdrawError:
+                    report.reject(row, "overdraw")
+                    continue
+                except TransactionLimitError:
+                    report.reject(row, "limit")
+                    continue
+                except TransactionSequenceError:
+                    report.reject(row, "sequence")
+                    continue
+
+                account.apply_transaction(amount, date)
+                account._count_unsaved(date)
+                pending.append({"_account_id": account_id, "_amount": amount,
+                                "_creation_date": date, "_interest_flag": 0,
+                                "_balance_after": account._balance})
+                touched.add(account)
+                report.accept()
+
+                if len(pending) >= chunk_size:
+                    self._insert_transactions(pending, touched, session)
+
+            if pending:
+                self._insert_transactions(pending, touched, session)
+            else:
+                session.commit()  # a last chunk of rejected rows still holds the lock
+        return report
+
+    def _insert_transactions(self, pending, touched, session):
+        """Bulk insert a chunk of imported transactions and commit it."""
+        session.execute(Transaction.__table__.insert(), pending)
+        # collections loaded before the insert do not know about the new rows
+        for account in touched:
+            session.expire(account, ["_transactions"])
+            account._saved()
+        ids = [account._id for account in touched]  # read before commit expires them
+        session.commit()
+        if self._summaries is not None:
+            for account_id in ids:
+                self._summaries.invalidate(account_id)
+
+        logging.debug("Imported transactions: %s", len(pending))
+        pending.clear()
+        touched.clear()
@@ -0,0 +1,71 @@
+"""Logging for the bank, set up once at startup with configure().
+
+Callers log through the standard logging functions with %-style
+arguments, so nothing is formatted unless the level is enabled. Records
+are put on a queue and a background listener formats them and writes
+them to a rotating log file, keeping file I/O off the request path.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+FORMAT = "%(asctime)s|%(levelname)s|%(message)s"
+DATEFMT = "%Y-%m-%d %H:%M:%S"
+
+_handler = None
+_listener = None
+_pid = None
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Queues records as they are; the listener thread formats them."""
+
+    def prepare(self, record):
+        return record
+
+
+def configure(filename="bank.log", level=None, max_bytes=10 * 1024 * 1024, backup_count=5):
+    """Route the root logger through the queue to a rotating log file.
+
+    The level defaults to the BANK_LOG_LEVEL environment variable, or DEBUG.
+    Calling it again in the same process does nothing; a forked worker
+    process gets its own listener."""
+    global _handler, _listener, _pid
+    if _listener is not None and _pid == os.getpid():
+        return
+
+    root = logging.getLogger()
+    if _handler is not None:
+        root.removeHandler(_handler)
+
+    if level is None:
+        level = os.environ.get("BANK_LOG_LEVEL", "DEBUG")
+    file_handler = logging.handlers.RotatingFileHandler(
+        filename, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+    file_handler.setFormatter(logging.Formatter(FORMAT, DATEFMT))
+
+    records = queue.SimpleQueue()
+    _handler = _QueueHandler(records)
+    root.addHandler(_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, file_handler)
+    _listener.start()
+    _pid = os.getpid()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Write out any queued records and stop the listener."""
+    global _handler, _listener
+    if _listener is None or _pid != os.getpid():
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    logging.getLogger().removeHandler(_handler)
+    _handler = None
+    _listener = None
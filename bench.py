@@ -0,0 +1,1069 @@
+"""Benchmarks for the bank models.
+
+Run ``python bench.py <benchmark> [options]``. Every benchmark builds its
+own throwaway database, so bank.db is never touched, except suite, which
+keeps the banks it generates with datagen in --data-dir so that later
+versions are timed on the very same files:
+
+    python bench.py suite --sizes 1000:100000 100000:10000000 --out before.json
+    python bench.py suite --sizes 1000:100000 100000:10000000 --out after.json --compare before.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+import random
+import resource
+import shutil
+import time
+import tracemalloc
+
+import sqlalchemy
+from sqlalchemy import func
+from sqlalchemy.orm.session import sessionmaker
+
+from account import Account
+from account import OverdrawError
+from bank import Bank
+from group_commit import GroupCommitter
+from ids import IdAllocator
+from ledger import CompactLedger
+import reconcile
+import replay
+from month_end import run_month_end, run_month_end_vectorized
+from shards import ShardedBank, shard_urls
+from statements import write_statements, write_statements_parallel
+from migrate import prepare
+import banklog
+import datagen
+import db
+from transaction import Base
+from transaction import Transaction
+
+
+def _session(url="sqlite://"):
+    """Returns a session bound to a freshly created database."""
+    engine = sqlalchemy.create_engine(url)
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+
+def _populate_accounts(session, count, chunk_size=50_000):
+    """Bulk insert a bank with count checking accounts and return the bank."""
+    bank = Bank()
+    session.add(bank)
+    session.commit()
+
+    today = datetime.date.today()
+    table = Account.__table__
+    for start in range(1, count + 1, chunk_size):
+        rows = [{"_id": i, "_bank_id": bank._id, "_balance": 0.0,
+                 "latest_date": today, "_interest_rate": 0.0012, "type": "Checking"}
+                for i in range(start, min(start + chunk_size, count + 1))]
+        session.execute(table.insert(), rows)
+    session.commit()
+    return bank
+
+
+def _per_call(fn, args):
+    """Returns the mean latency of fn over args in microseconds."""
+    start = time.perf_counter()
+    for arg in args:
+        fn(arg)
+    return (time.perf_counter() - start) / len(args) * 1e6
+
+
+def bench_find_account(sizes, lookups, scan_max):
+    """Compare the old linear scan with the primary key and index lookups."""
+    print(f"{'accounts':>10} {'scan us':>12} {'get us':>10} {'index build s':>14} {'index us':>10}")
+    for size in sizes:
+        session = _session()
+        bank = _populate_accounts(session, size)
+        ids = [str(random.randint(1, size)) for _ in range(lookups)]
+
+        def linear(account_id):
+            for account in bank._accounts:
+                if account.id_matches(account_id):
+                    return account
+
+        scan = "-"
+        if size <= scan_max:
+            scan = f"{_per_call(linear, ids[:max(1, lookups // 10)]):.1f}"
+        get = _per_call(lambda i: bank.find_account(i, session), ids)
+
+        start = time.perf_counter()
+        bank._account_index()
+        build = time.perf_counter() - start
+        index = _per_call(bank.find_account, ids)
+
+        print(f"{size:>10} {scan:>12} {get:>10.1f} {build:>14.3f} {index:>10.2f}")
+        session.close()
+
+
+def bench_check_limits(histories, checks):
+    """Compare the old history scan in SavingsAccount._check_limits with the
+    indexed counts it makes now."""
+    print(f"{'history':>10} {'scan us':>12} {'counts us':>12}")
+    for history in histories:
+        session = _session()
+        bank = _populate_accounts(session, 0)
+        account = bank.new_account("savings", session)
+        session.commit()
+
+        # one transaction per day, going back far enough to hold the history
+        start = datetime.date.today() - datetime.timedelta(days=history)
+        rows = [{"_account_id": account.get_id(), "_amount": 1.0, "_interest_flag": 0,
+                 "_creation_date": start + datetime.timedelta(days=i)}
+                for i in range(history)]
+        session.execute(Transaction.__table__.insert(), rows)
+        session.commit()
+        dates = [start + datetime.timedelta(days=random.randrange(history + 1))
+                 for _ in range(checks)]
+
+        def scan(date):
+            day_counter = 0
+            month_counter = 0
+            for transaction in account._transactions:
+                if transaction.check_day_limit(date):
+                    day_counter += 1
+                if transaction.check_month_limit(date):
+                    month_counter += 1
+            return day_counter < 2 and month_counter < 5
+
+        old = _per_call(scan, dates)
+        new = _per_call(lambda date: account._check_limits(1, date), dates)
+        assert [scan(d) for d in dates] == [account._check_limits(1, d) for d in dates]
+
+        print(f"{history:>10} {old:>12.1f} {new:>12.2f}")
+        session.close()
+
+
+def _settlement_rows(accounts, count):
+    """Returns count deposit rows spread over the given number of accounts."""
+    today = datetime.date.today()
+    return [(random.randint(1, accounts), Decimal(random.randint(1, 50000)) / 100, today)
+            for _ in range(count)]
+
+
+def bench_import(rows, accounts, chunk_size, single_rows):
+    """Compare rows per second of add_transaction with Bank.import_transactions."""
+    session = _session()
+    bank = _populate_accounts(session, accounts)
+    sample = _settlement_rows(accounts, single_rows)
+    start = time.perf_counter()
+    for account_id, amount, date in sample:
+        bank.find_account(account_id, session).add_transaction(amount, date, session)
+        session.commit()
+    single = single_rows / (time.perf_counter() - start)
+    session.close()
+
+    session = _session()
+    bank = _populate_accounts(session, accounts)
+    settlement = _settlement_rows(accounts, rows)
+    start = time.perf_counter()
+    report = bank.import_transactions(settlement, session, chunk_size)
+    bulk = rows / (time.perf_counter() - start)
+    session.close()
+
+    print(f"add_transaction + commit: {single:>10.0f} rows/s ({single_rows} rows)")
+    print(f"import_transactions:      {bulk:>10.0f} rows/s ({report})")
+
+
+def bench_logging(transactions):
+    """Per-transaction cost of the old per-call basicConfig logging and of the
+    queued logger, at DEBUG and with DEBUG turned off."""
+    root = logging.getLogger()
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "bank.log")
+
+        def old(i):
+            logging.basicConfig(filename=filename, level=logging.DEBUG, format=banklog.FORMAT, datefmt=banklog.DATEFMT)
+            logging.debug(f"Created transaction: {i}, {Decimal(i)}")
+
+        def new(i):
+            logging.debug("Created transaction: %s, %s", i, Decimal(i))
+
+        calls = range(transactions)
+        before = _per_call(old, calls)
+        root.setLevel(logging.INFO)
+        before_off = _per_call(old, calls)
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+            handler.close()
+
+        banklog.configure(filename, level="DEBUG")
+        after = _per_call(new, calls)
+        root.setLevel(logging.INFO)
+        after_off = _per_call(new, calls)
+        banklog.shutdown()
+
+    print(f"{'':>24} {'DEBUG us':>10} {'INFO us':>10}")
+    print(f"{'basicConfig per call':>24} {before:>10.2f} {before_off:>10.2f}")
+    print(f"{'queued logger':>24} {after:>10.2f} {after_off:>10.2f}")
+
+
+def _stress_worker(url, accounts, operations, seed):
+    """Random deposits and withdrawals, one commit each. Returns the
+    accepted total per account and the number of overdraws."""
+    engine = db.create_engine(url, concurrent=True)
+    session = sessionmaker(bind=engine)()
+    bank = session.query(Bank).first()
+    today = datetime.date.today()
+    rng = random.Random(seed)
+    totals = Counter()
+    overdrawn = 0
+    for _ in range(operations):
+        account_id = rng.randint(1, accounts)
+        amount = Decimal(rng.randint(-5000, 5000)) / 100
+        try:
+            db.begin_write(session)
+            bank.find_account(account_id, session).add_transaction(amount, today, session)
+            session.commit()
+            totals[account_id] += amount
+        except OverdrawError:
+            session.rollback()
+            overdrawn += 1
+    session.close()
+    engine.dispose()
+    return totals, overdrawn
+
+
+def bench_stress(workers, accounts, operations):
+    """Several processes adding transactions to the same accounts in one
+    database file; checks every accepted transaction made it into the balances."""
+    with tempfile.TemporaryDirectory() as directory:
+        url = f"sqlite:///{os.path.join(directory, 'bank.db')}"
+        engine = db.create_engine(url, concurrent=True)
+        prepare(engine)
+        session = sessionmaker(bind=engine)()
+        bank = _populate_accounts(session, accounts)
+        today = datetime.date.today()
+        bank.import_transactions([(i, 100, today) for i in range(1, accounts + 1)], session)
+        session.close()
+
+        start = time.perf_counter()
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(_stress_worker, url, accounts, operations, seed)
+                       for seed in range(workers)]
+            results = [future.result() for future in futures]
+        elapsed = time.perf_counter() - start
+
+        totals = Counter({i: Decimal(100) for i in range(1, accounts + 1)})
+        for worker_totals, _ in results:
+            totals.update(worker_totals)
+        overdrawn = sum(r[1] for r in results)
+
+        session = sessionmaker(bind=engine)()
+        stored = dict(session.query(Account._id, Account._balance))
+        logged = dict(session.query(Transaction._account_id, func.sum(Transaction._amount))
+                      .group_by(Transaction._account_id))
+        session.close()
+        engine.dispose()
+
+    mismatched = [i for i in totals if not stored[i] == totals[i] == logged[i]]
+    print(f"{workers} workers: {workers * operations / elapsed:.0f} transactions/s, "
+          f"{overdrawn} overdraws refused")
+    print("final balances", "match" if not mismatched else f"DIFFER for accounts {mismatched[:10]}")
+    if any(balance < 0 for balance in stored.values()):
+        print("some balances went negative")
+
+
+def _open_worker(url, count, block_size, chunk_size):
+    """Open count accounts, committing every chunk_size of them."""
+    engine = db.create_engine(url, concurrent=True, immediate=True)
+    session = sessionmaker(bind=engine)()
+    bank = session.query(Bank).first()
+    ids = IdAllocator(session, block_size) if block_size else None
+    for i in range(1, count + 1):
+        bank.new_account("checking", session, ids)
+        if i % chunk_size == 0:
+            session.commit()
+    session.commit()
+    session.close()
+    engine.dispose()
+
+
+def _shard_worker(urls, accounts, operations, seed):
+    """Random deposits on the accounts of a ShardedBank, one commit each."""
+    bank = ShardedBank(urls)
+    today = datetime.date.today()
+    rng = random.Random(seed)
+    for _ in range(operations):
+        shard = rng.choice(bank.shards)
+        db.begin_write(shard.session)
+        account = bank.find_account(shard.first_id + rng.randrange(accounts))
+        account.add_transaction(Decimal(rng.randint(1, 5000)) / 100, today, shard.session)
+        shard.session.commit()
+    bank.close()
+
+
+def bench_shards(shard_counts, workers, accounts, operations):
+    """Transactions per second from several writer processes, each
+    committing every transaction, with the accounts on one database file
+    and spread over several shards."""
+    for count in shard_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            urls = shard_urls(os.path.join(directory, "bank.db"), count)
+            bank = ShardedBank(urls)
+            today = datetime.date.today()
+            for shard in bank.shards:
+                rows = [{"_id": shard.first_id + i, "_bank_id": shard.bank._id, "_balance": 0,
+                         "latest_date": today, "_interest_rate": Decimal("0.0012"), "type": "Checking"}
+                        for i in range(accounts)]
+                shard.session.execute(Account.__table__.insert(), rows)
+            bank.commit()
+            bank.close()
+
+            start = time.perf_counter()
+            with ProcessPoolExecutor(workers) as pool:
+                futures = [pool.submit(_shard_worker, urls, accounts, operations, seed)
+                           for seed in range(workers)]
+                for future in futures:
+                    future.result()
+            elapsed = time.perf_counter() - start
+        label = "one file" if count == 1 else f"{count} shards"
+        print(f"{label:>10}: {workers * operations / elapsed:>8.0f} transactions/s ({workers} workers)")
+
+
+def bench_open_accounts(workers, accounts, block_size, chunk_size):
+    """Accounts opened per second by several processes sharing one database,
+    with ids assigned per flush and with reserved id blocks."""
+    for label, block in (("flush per account", 0), (f"blocks of {block_size}", block_size)):
+        with tempfile.TemporaryDirectory() as directory:
+            url = f"sqlite:///{os.path.join(directory, 'bank.db')}"
+            engine = db.create_engine(url, concurrent=True)
+            prepare(engine)
+            session = sessionmaker(bind=engine)()
+            _populate_accounts(session, 0)
+            session.close()
+
+            start = time.perf_counter()
+            with ProcessPoolExecutor(workers) as pool:
+                futures = [pool.submit(_open_worker, url, accounts, block, chunk_size)
+                           for _ in range(workers)]
+                for future in futures:
+                    future.result()
+            elapsed = time.perf_counter() - start
+
+            with engine.connect() as conn:
+                opened, distinct = conn.execute(sqlalchemy.select(
+                    func.count(), func.count(func.distinct(Account._id)))).one()
+            engine.dispose()
+        print(f"{label:>20}: {opened / elapsed:>10.0f} accounts/s "
+              f"({opened} opened, {distinct} distinct ids)")
+
+
+async def _async_load(url, clients, accounts, operations, max_batch, max_delay):
+    """Run clients concurrent coroutines against one AsyncBank and return
+    the per-transaction latencies and the elapsed time."""
+    from async_bank import AsyncBank
+
+    bank = await AsyncBank.open(url, max_batch, max_delay)
+    ids = [await bank.open_account("checking", Decimal(1_000_000)) for _ in range(accounts)]
+    today = datetime.date.today()
+    latencies = []
+
+    async def client(seed):
+        rng = random.Random(seed)
+        for _ in range(operations):
+            amount = Decimal(rng.randint(-5000, 5000)) / 100
+            start = time.perf_counter()
+            try:
+                await bank.add_transaction(rng.choice(ids), amount, today)
+            except OverdrawError:
+                pass
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(seed) for seed in range(clients)))
+    elapsed = time.perf_counter() - start
+    await bank.close()
+    return latencies, elapsed
+
+
+def bench_async_load(clients, accounts, operations, max_batches, max_delay):
+    """Latency and throughput of the asyncio API with many concurrent
+    clients, for a range of group commit batch sizes (1 = commit per write)."""
+    for max_batch in max_batches:
+        with tempfile.TemporaryDirectory() as directory:
+            url = f"sqlite+aiosqlite:///{os.path.join(directory, 'bank.db')}"
+            latencies, elapsed = asyncio.run(
+                _async_load(url, clients, accounts, operations, max_batch, max_delay))
+        p50, p99 = (statistics.quantiles(latencies, n=100)[i] for i in (49, 98))
+        print(f"batch {max_batch:>5}: {len(latencies) / elapsed:>8.0f} transactions/s, "
+              f"p50 {p50 * 1000:.2f} ms, p99 {p99 * 1000:.2f} ms")
+
+
+def bench_group_commit(writes, batch_sizes, concurrent):
+    """Writes per second from one teller session on a database file,
+    committing each write (no journal) against group commits of several
+    sizes with every write journaled and fsynced first."""
+    for batch in [1] + batch_sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            engine = db.create_engine(f"sqlite:///{os.path.join(directory, 'bank.db')}", concurrent)
+            prepare(engine)
+            session = sessionmaker(bind=engine)()
+            bank = Bank()
+            session.add(bank)
+            session.commit()
+            journal = os.path.join(directory, "bank.journal") if batch > 1 else None
+            committer = GroupCommitter(session, bank, journal, batch, max_delay=60)
+            account = committer.write("open_account", account_type="checking")
+            account_id = account.get_id()
+            today = datetime.date.today()
+
+            start = time.perf_counter()
+            for _ in range(writes):
+                committer.write("add_transaction", account=account_id, amount=Decimal("1.25"), date=today)
+            committer.close()
+            elapsed = time.perf_counter() - start
+            session.close()
+            engine.dispose()
+        label = "commit per write" if batch == 1 else f"batches of {batch}"
+        print(f"{label:>18}: {writes / elapsed:>8.0f} writes/s")
+
+
+def _month_end_rows(session, last_id):
+    """The account and transaction rows of the accounts up to last_id."""
+    accounts = session.execute(sqlalchemy.text(
+        "SELECT _id, _balance, latest_date FROM account WHERE _id <= :last ORDER BY _id"),
+        {"last": last_id}).all()
+    transactions = session.execute(sqlalchemy.text(
+        'SELECT _account_id, _creation_date, _amount, _interest_flag, _balance_after '
+        'FROM "transaction" WHERE _account_id <= :last ORDER BY _account_id, _id'),
+        {"last": last_id}).all()
+    return accounts, transactions
+
+
+def bench_month_end(accounts, scalar_max, chunk_size):
+    """Accounts per second through month-end interest and fees, one
+    Account at a time and vectorized with NumPy, on copies of a database
+    file with a mix of checking and savings balances. The accounts both
+    assess must come out the same to the cent."""
+    with tempfile.TemporaryDirectory() as directory:
+        scalar_path = os.path.join(directory, "scalar.db")
+        vectorized_path = os.path.join(directory, "vectorized.db")
+        session = _session(f"sqlite:///{scalar_path}")
+        bank_id = _populate_accounts(session, accounts)._id
+        session.connection().exec_driver_sql(
+            "UPDATE account SET _balance = abs(random()) % 2000000, "
+            "type = CASE WHEN _id % 2 THEN 'Savings' ELSE 'Checking' END, "
+            "_interest_rate = CASE WHEN _id % 2 THEN 29000 ELSE 1200 END")
+        session.commit()
+        shutil.copyfile(scalar_path, vectorized_path)
+
+        scalar = min(scalar_max, accounts)
+        start = time.perf_counter()
+        run_month_end(session, bank_id, 1000, 1, scalar)
+        scalar_time = time.perf_counter() - start
+        expected = _month_end_rows(session, scalar)
+        session.close()
+
+        session = sessionmaker(bind=sqlalchemy.create_engine(f"sqlite:///{vectorized_path}"))()
+        start = time.perf_counter()
+        assessed, _ = run_month_end_vectorized(session, bank_id, chunk_size)
+        vectorized_time = time.perf_counter() - start
+        assert _month_end_rows(session, scalar) == expected
+        session.close()
+
+    print(f"{'one at a time':>14}: {scalar / scalar_time:>10.0f} accounts/s ({scalar} accounts)")
+    print(f"{'vectorized':>14}: {assessed / vectorized_time:>10.0f} accounts/s ({assessed} accounts)")
+
+
+def bench_ledger_memory(transactions, accounts, orm_max):
+    """Memory held by a loaded transaction log as ORM Transactions and as a
+    CompactLedger. The ORM figure is measured on orm_max rows and scaled up."""
+    with tempfile.TemporaryDirectory() as directory:
+        session = _session(f"sqlite:///{os.path.join(directory, 'bank.db')}")
+        _populate_accounts(session, accounts)
+        session.execute(sqlalchemy.text(
+            'INSERT INTO "transaction" (_account_id, _creation_date, _amount, _interest_flag) '
+            "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < :count) "
+            "SELECT 1 + i % :accounts, date('2020-01-01', '+' || (i / 5000) || ' days'), "
+            "abs(random()) % 100000 - 50000, i % 50 = 0 FROM n"),
+            {"count": transactions, "accounts": accounts})
+        session.commit()
+
+        sample = min(orm_max, transactions)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        rows = session.query(Transaction).limit(sample).all()
+        orm_bytes = (tracemalloc.get_traced_memory()[0] - before) / sample
+        tracemalloc.stop()
+        del rows
+        session.expunge_all()
+
+        start = time.perf_counter()
+        ledger = CompactLedger.load(session.connection())
+        load_time = time.perf_counter() - start
+        compact_bytes = sum(sys.getsizeof(getattr(ledger, c)) for c in CompactLedger.__slots__) / len(ledger)
+        session.close()
+
+        start = time.perf_counter()
+        ledger.total()
+        ledger.limit_counts()
+        ledger.in_month(2021, 6)
+        query_time = time.perf_counter() - start
+
+    print(f"{'ORM':>8}: {orm_bytes:>7.1f} bytes/transaction, "
+          f"{orm_bytes * transactions / 2**20:>8.0f} MiB for {transactions} (from {sample})")
+    print(f"{'compact':>8}: {compact_bytes:>7.1f} bytes/transaction, "
+          f"{compact_bytes * transactions / 2**20:>8.0f} MiB, loaded in {load_time:.1f} s, "
+          f"total + limit counts + month filter in {query_time:.1f} s")
+
+
+def _index_queries(session, banks, ids, date):
+    """Mean milliseconds of each hot query over the savings accounts ids."""
+    queries = [
+        ("accounts of a bank", lambda i: session.query(Account).filter(Account._bank_id == 1 + i % banks).all()),
+        ("transactions page", lambda i: session.get(Account, i).transactions_page(session, None, 50)),
+        ("balance as of", lambda i: session.get(Account, i).balance_as_of(date, session)),
+        ("interest applied", lambda i: session.get(Account, i).interest_applied(date, session)),
+        ("limit check", lambda i: session.get(Account, i)._check_limits(Decimal(1), date)),
+    ]
+    times = {}
+    for name, query in queries:
+        start = time.perf_counter()
+        for i in ids:
+            session.expunge_all()
+            query(i)
+        times[name] = (time.perf_counter() - start) / len(ids) * 1000
+        session.rollback()
+    return times
+
+
+def bench_indexes(transactions, accounts, banks, lookups, scan_lookups):
+    """Hot query latency on a database file with and without the account
+    and transaction indexes. Every account is in one of banks banks and
+    the transactions are spread evenly over the accounts and four years."""
+    with tempfile.TemporaryDirectory() as directory:
+        session = _session(f"sqlite:///{os.path.join(directory, 'bank.db')}")
+        indexes = [index for table in (Account.__table__, Transaction.__table__) for index in table.indexes]
+        conn = session.connection()
+        for index in indexes:
+            index.drop(conn)
+        conn.exec_driver_sql(
+            "INSERT INTO bank (_id) WITH RECURSIVE n(i) AS "
+            f"(SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < {banks}) SELECT i FROM n")
+        conn.exec_driver_sql(
+            "INSERT INTO account (_id, _bank_id, _balance, latest_date, _interest_rate, type) "
+            f"WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < {accounts}) "
+            f"SELECT i, 1 + i % {banks}, 100000, '2030-01-01', "
+            "CASE WHEN i % 2 THEN 29000 ELSE 1200 END, "
+            "CASE WHEN i % 2 THEN 'Savings' ELSE 'Checking' END FROM n")
+        conn.exec_driver_sql(
+            'INSERT INTO "transaction" (_account_id, _creation_date, _amount, _interest_flag, _balance_after) '
+            f"WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < {transactions}) "
+            f"SELECT 1 + i % {accounts}, date('2020-01-01', '+' || (i * 1460 / {transactions}) || ' days'), "
+            "abs(random()) % 100000, i % 50 = 0, abs(random()) % 10000000 FROM n")
+        session.commit()
+
+        start = time.perf_counter()
+        conn = session.connection()
+        for index in indexes:
+            index.create(conn)
+        session.commit()
+        build = time.perf_counter() - start
+
+        savings = list(range(1, accounts + 1, 2))
+        ids = [random.choice(savings) for _ in range(lookups)]
+        date = datetime.date(2022, 6, 30)
+        indexed = _index_queries(session, banks, ids, date)
+
+        conn = session.connection()
+        for index in indexes:
+            index.drop(conn)
+        session.commit()
+        scanned = _index_queries(session, banks, ids[:scan_lookups], date)
+        session.close()
+
+    print(f"{transactions} transactions, {accounts} accounts in {banks} banks; indexes built in {build:.1f} s")
+    print(f"{'query':>20} {'no index ms':>12} {'indexed ms':>11} {'speed-up':>9}")
+    for name in indexed:
+        print(f"{name:>20} {scanned[name]:>12.2f} {indexed[name]:>11.3f} {scanned[name] / indexed[name]:>8.0f}x")
+
+
+def bench_statements(accounts, transactions, workers, orm_max):
+    """Statements per second for one month of a bank, written by the old
+    per-account sort_transactions path and by the streaming statement
+    writer with a range of worker processes. The transactions are spread
+    over two months, so half of them are history before the statement."""
+    with tempfile.TemporaryDirectory() as directory:
+        url = f"sqlite:///{os.path.join(directory, 'bank.db')}"
+        session = _session(url)
+        bank_id = _populate_accounts(session, accounts)._id
+        session.execute(sqlalchemy.text(
+            'INSERT INTO "transaction" (_account_id, _creation_date, _amount, _interest_flag, _balance_after) '
+            "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < :count) "
+            "SELECT 1 + i % :accounts, date('2024-01-01', '+' || (i * 60 / :count) || ' days'), "
+            "abs(random()) % 100000 - 50000, i % 50 = 0, abs(random()) % 10000000 FROM n"),
+            {"count": transactions, "accounts": accounts})
+        session.commit()
+
+        sample = min(orm_max, accounts)
+        start = time.perf_counter()
+        with open(os.path.join(directory, "orm.txt"), "w") as out:
+            for account in session.query(Account).order_by(Account._id).limit(sample):
+                out.write(f"{account}\n")
+                for transaction in account.sort_transactions():
+                    if transaction._creation_date.month == 2:
+                        out.write(f"{transaction}\n")
+        orm = sample / (time.perf_counter() - start)
+        session.close()
+        print(f"{'sort_transactions':>20}: {orm:>10.0f} statements/s ({sample} accounts)")
+
+        for count in workers:
+            out_dir = os.path.join(directory, f"out{count}")
+            os.mkdir(out_dir)
+            start = time.perf_counter()
+            if count == 1:
+                with sqlalchemy.create_engine(url).connect() as conn, \
+                        open(os.path.join(out_dir, "statements.txt"), "w", buffering=1 << 20) as out:
+                    written = write_statements(conn, bank_id, 2024, 2, out)
+            else:
+                written, _ = write_statements_parallel(url, bank_id, 2024, 2, out_dir, count)
+            elapsed = time.perf_counter() - start
+            size = sum(entry.stat().st_size for entry in os.scandir(out_dir))
+            print(f"{f'streamed, {count} worker' + ('s' if count > 1 else ''):>20}: "
+                  f"{written / elapsed:>10.0f} statements/s ({written} accounts, {size / 2**20:.0f} MiB)")
+
+
+def bench_reconcile(accounts, transactions, workers, orm_max):
+    """Transactions per second reconciled on a generated bank: by walking
+    each account's ORM transactions, and by reconcile.py with a range of
+    worker processes."""
+    with tempfile.TemporaryDirectory() as directory:
+        url = f"sqlite:///{os.path.join(directory, 'bank.db')}"
+        rows = datagen.generate(url, accounts, transactions)
+
+        engine = sqlalchemy.create_engine(url)
+        session = sessionmaker(bind=engine)()
+        checked = 0
+        start = time.perf_counter()
+        for account in session.query(Account).order_by(Account._id).limit(orm_max):
+            history = account.sort_transactions()
+            assert account._balance == sum(t._amount for t in history)
+            checked += len(history)
+        orm = checked / (time.perf_counter() - start)
+        session.close()
+        engine.dispose()
+        print(f"{'ORM':>12}: {orm:>10.0f} transactions/s ({min(orm_max, accounts)} accounts)")
+
+        for count in workers:
+            start = time.perf_counter()
+            _, checked, discrepancies = reconcile.reconcile(url, count)
+            elapsed = time.perf_counter() - start
+            assert checked == rows and not discrepancies
+            print(f"{f'{count} worker' + ('s' if count > 1 else ''):>12}: {checked / elapsed:>10.0f} "
+                  f"transactions/s ({checked} in {elapsed:.1f} s)")
+
+
+def _replay_worker(url, chunk_size, full):
+    """Replay in a fresh process; returns the rows, seconds and peak RSS in MiB."""
+    engine = sqlalchemy.create_engine(url)
+    start = time.perf_counter()
+    replayed = replay.replay(engine, chunk_size, full)
+    elapsed = time.perf_counter() - start
+    engine.dispose()
+    return replayed, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_replay(transactions, accounts, chunk_size, appended):
+    """Full and incremental ledger replay throughput, with the peak memory
+    of the replaying process, and the time to verify every account."""
+    with tempfile.TemporaryDirectory() as directory:
+        url = f"sqlite:///{os.path.join(directory, 'bank.db')}"
+        engine = sqlalchemy.create_engine(url)
+        prepare(engine)
+        session = sessionmaker(bind=engine)()
+        _populate_accounts(session, accounts)
+        insert = sqlalchemy.text(
+            'INSERT INTO "transaction" (_account_id, _creation_date, _amount, _interest_flag, _balance_after) '
+            "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < :count) "
+            "SELECT 1 + abs(random()) % :accounts, date('2020-01-01', '+' || (i * 1460 / :count) || ' days'), "
+            "abs(random()) % 100000, 0, 0 FROM n")
+        session.execute(insert, {"count": transactions, "accounts": accounts})
+        session.commit()
+
+        with ProcessPoolExecutor(1) as pool:
+            full = pool.submit(_replay_worker, url, chunk_size, True).result()
+        session.execute(insert, {"count": appended, "accounts": accounts})
+        session.commit()
+        with ProcessPoolExecutor(1) as pool:
+            incremental = pool.submit(_replay_worker, url, chunk_size, False).result()
+
+        start = time.perf_counter()
+        drifted = sum(1 for _ in replay.verify(session.connection()))
+        verify_time = time.perf_counter() - start
+        session.close()
+        engine.dispose()
+
+    for label, (replayed, elapsed, rss) in (("full", full), ("incremental", incremental)):
+        print(f"{label:>12}: {replayed:>11} transactions in {elapsed:>6.1f} s, "
+              f"{replayed / elapsed:>10.0f}/s, peak RSS {rss:.0f} MiB")
+    print(f"{'verify':>12}: {accounts:>11} accounts in {verify_time:>6.1f} s "
+          f"({drifted} drifted, the generated balances are not kept in step)")
+
+
+def _until_prompt(process):
+    """Read the process's output up to and including its next '>' prompt."""
+    while True:
+        char = process.stdout.read(1)
+        if char in (">", ""):
+            return
+
+
+def bench_startup(accounts, runs):
+    """Wall time of BankCLI start-up on a database of accounts accounts:
+    the import of its modules, time to the first prompt, and time until a
+    first command (a summary) has been answered."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=here, PYTHONWARNINGS="ignore")
+    with tempfile.TemporaryDirectory() as directory:
+        engine = sqlalchemy.create_engine(f"sqlite:///{os.path.join(directory, 'bank.db')}")
+        prepare(engine)
+        session = sessionmaker(bind=engine)()
+        _populate_accounts(session, accounts)
+        session.close()
+        engine.dispose()
+
+        def wall(command):
+            start = time.perf_counter()
+            subprocess.run(command, cwd=directory, env=env, check=True, capture_output=True)
+            return time.perf_counter() - start
+
+        interpreter = min(wall([sys.executable, "-c", "pass"]) for _ in range(runs))
+        models = min(wall([sys.executable, "-c", "import bank, db, group_commit, migrate"]) for _ in range(runs))
+
+        prompt = []
+        answered = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            process = subprocess.Popen([sys.executable, os.path.join(here, "BankCLI.py")], cwd=directory,
+                                       env=env, text=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            _until_prompt(process)
+            prompt.append(time.perf_counter() - start)
+            process.stdin.write("2\n")
+            process.stdin.flush()
+            _until_prompt(process)
+            answered.append(time.perf_counter() - start)
+            process.communicate("7\n")
+
+    print(f"{'interpreter':>16}: {interpreter * 1000:>7.0f} ms")
+    print(f"{'import models':>16}: {(models - interpreter) * 1000:>7.0f} ms")
+    print(f"{'first prompt':>16}: {min(prompt) * 1000:>7.0f} ms")
+    print(f"{'first summary':>16}: {min(answered) * 1000:>7.0f} ms ({accounts} accounts)")
+
+
+def _suite_database(directory, accounts, transactions, seed):
+    """The path of the generated bank of the given size, generating it the
+    first time. Kept between runs, so every version is timed on the same file."""
+    path = os.path.join(directory, f"bank-{accounts}-{transactions}-{seed}.db")
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        partial = path + ".partial"
+        if os.path.exists(partial):
+            os.remove(partial)
+        start = time.perf_counter()
+        rows = datagen.generate(f"sqlite:///{partial}", accounts, transactions, seed)
+        os.replace(partial, path)
+        print(f"generated {path}: {rows} transactions in {time.perf_counter() - start:.0f} s")
+    return path
+
+
+def _latencies(fn, args):
+    """Times fn on each of args; returns the count, mean, median, p95 and
+    max latency in microseconds."""
+    samples = []
+    for arg in args:
+        start = time.perf_counter()
+        fn(arg)
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {"count": len(samples),
+            "mean_us": statistics.fmean(samples),
+            "p50_us": samples[len(samples) // 2],
+            "p95_us": samples[int(len(samples) * 0.95)],
+            "max_us": samples[-1]}
+
+
+def _suite_operations(path, samples, seed):
+    """Time the core operations on the bank at path. Every write is rolled
+    back, so the file is the same for the next run."""
+    engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+    prepare(engine)
+    session = sessionmaker(bind=engine)()
+    rng = random.Random(seed)
+    bank_id = session.query(Bank._id).scalar()
+    last_date = session.query(func.max(Account.latest_date)).scalar()
+    open_month = last_date.replace(day=1)
+    # the day after the generated range, so no limit has been reached on it
+    today = last_date + datetime.timedelta(days=1)
+
+    def sample(query):
+        ids = [row[0] for row in session.execute(query)]
+        return rng.sample(ids, min(samples, len(ids)))
+
+    table = Account.__table__
+    any_ids = sample(sqlalchemy.select(table.c._id))
+    savings_ids = sample(sqlalchemy.select(table.c._id).where(table.c.type == "Savings"))
+    open_ids = sample(sqlalchemy.select(table.c._id).where(table.c.latest_date >= open_month))
+
+    def fresh(ids):
+        """The accounts, loaded anew so nothing is cached from a previous step."""
+        session.rollback()
+        session.expunge_all()
+        return [session.get(Account, account_id) for account_id in ids]
+
+    results = {}
+    session.expunge_all()
+    bank = session.get(Bank, bank_id)
+    found = []
+    results["find_account"] = _latencies(lambda i: found.append(bank.find_account(i, session)), any_ids)
+    assert None not in found
+
+    def deposit(account):
+        account.add_transaction(Decimal(10), today, session)
+        session.flush()
+    results["add_transaction"] = _latencies(deposit, fresh(any_ids))
+
+    savings = fresh(savings_ids)
+    results["check_limits"] = _latencies(lambda a: a._check_limits(1, today), savings)
+
+    def assess(account):
+        account.assess_interest_and_fees(session)
+        session.flush()
+    results["assess_interest_and_fees"] = _latencies(assess, fresh(open_ids))
+
+    session.rollback()
+    session.close()
+    engine.dispose()
+    return results
+
+
+def _git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _suite_size(text):
+    accounts, _, transactions = text.partition(":")
+    return int(accounts), int(transactions)
+
+
+def bench_suite(sizes, samples, seed, data_dir, out, compare):
+    """Time add_transaction, _check_limits, find_account and
+    assess_interest_and_fees on generated banks of each size and write the
+    results to out as JSON. With compare, print the change in median from
+    an earlier results file."""
+    results = {"version": _git_version(),
+               "time": datetime.datetime.now().isoformat(timespec="seconds"),
+               "python": sys.version.split()[0],
+               "sqlite": sqlite3.sqlite_version,
+               "sqlalchemy": sqlalchemy.__version__,
+               "seed": seed,
+               "samples": samples,
+               "sizes": []}
+    for accounts, transactions in sizes:
+        path = _suite_database(data_dir, accounts, transactions, seed)
+        operations = _suite_operations(path, samples, seed)
+        results["sizes"].append({"accounts": accounts, "transactions": transactions,
+                                 "operations": operations})
+        for name, timing in operations.items():
+            print(f"{accounts:>9} {transactions:>11} {name:>26}: "
+                  f"p50 {timing['p50_us']:>9.1f} us  p95 {timing['p95_us']:>9.1f} us  "
+                  f"mean {timing['mean_us']:>9.1f} us")
+
+    with open(out, "w") as f:
+        json.dump(results, f, indent=1)
+    print(f"results in {out}")
+
+    if compare:
+        with open(compare) as f:
+            before = json.load(f)
+        earlier = {(s["accounts"], s["transactions"]): s["operations"] for s in before["sizes"]}
+        print(f"median against {before.get('version') or compare}:")
+        for size in results["sizes"]:
+            old = earlier.get((size["accounts"], size["transactions"]))
+            if old is None:
+                continue
+            for name, timing in size["operations"].items():
+                if name in old:
+                    ratio = timing["p50_us"] / old[name]["p50_us"]
+                    print(f"{size['accounts']:>9} {size['transactions']:>11} {name:>26}: "
+                          f"{old[name]['p50_us']:>9.1f} -> {timing['p50_us']:>9.1f} us ({ratio:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="benchmark", required=True)
+
+    find = commands.add_parser("find_account", help="account lookup latency")
+    find.add_argument("--sizes", type=int, nargs="+",
+                      default=[1_000, 10_000, 100_000, 1_000_000])
+    find.add_argument("--lookups", type=int, default=1_000)
+    find.add_argument("--scan-max", type=int, default=100_000,
+                      help="largest size to run the linear scan baseline on")
+
+    limits = commands.add_parser("check_limits", help="savings limit check cost")
+    limits.add_argument("--histories", type=int, nargs="+",
+                        default=[100, 1_000, 10_000, 100_000])
+    limits.add_argument("--checks", type=int, default=200)
+
+    imports = commands.add_parser("import", help="transaction import throughput")
+    imports.add_argument("--rows", type=int, default=1_000_000)
+    imports.add_argument("--accounts", type=int, default=1_000)
+    imports.add_argument("--chunk-size", type=int, default=10_000)
+    imports.add_argument("--single-rows", type=int, default=2_000,
+                         help="rows to add one at a time for the baseline")
+
+    logs = commands.add_parser("logging", help="logging cost per transaction")
+    logs.add_argument("--transactions", type=int, default=100_000)
+
+    stress = commands.add_parser("stress", help="concurrent writers on one database file")
+    stress.add_argument("--workers", type=int, default=4)
+    stress.add_argument("--accounts", type=int, default=20)
+    stress.add_argument("--operations", type=int, default=500,
+                        help="transactions per worker")
+
+    opening = commands.add_parser("open_accounts", help="account opening rate")
+    opening.add_argument("--workers", type=int, default=4)
+    opening.add_argument("--accounts", type=int, default=10_000,
+                         help="accounts per worker")
+    opening.add_argument("--block-size", type=int, default=1_000)
+    opening.add_argument("--chunk-size", type=int, default=1_000,
+                         help="accounts per commit")
+
+    memory = commands.add_parser("ledger_memory", help="memory of a loaded transaction log")
+    memory.add_argument("--transactions", type=int, default=10_000_000)
+    memory.add_argument("--accounts", type=int, default=1_000)
+    memory.add_argument("--orm-max", type=int, default=200_000,
+                        help="rows to load as ORM objects for the baseline")
+
+    month = commands.add_parser("month_end", help="month-end interest and fees throughput")
+    month.add_argument("--accounts", type=int, default=1_000_000)
+    month.add_argument("--scalar-max", type=int, default=20_000,
+                       help="accounts to run one at a time for the baseline")
+    month.add_argument("--chunk-size", type=int, default=100_000)
+
+    grouped = commands.add_parser("group_commit", help="teller writes with and without group commit")
+    grouped.add_argument("--writes", type=int, default=2_000)
+    grouped.add_argument("--batch-sizes", type=int, nargs="+", default=[10, 100, 1_000])
+    grouped.add_argument("--concurrent", action="store_true",
+                         help="use the WAL engine the tellers share instead of the default")
+
+    startup = commands.add_parser("startup", help="BankCLI start-up time")
+    startup.add_argument("--accounts", type=int, default=1_000)
+    startup.add_argument("--runs", type=int, default=5)
+
+    load = commands.add_parser("async_load", help="asyncio API latency under concurrent clients")
+    load.add_argument("--clients", type=int, default=100)
+    load.add_argument("--accounts", type=int, default=100)
+    load.add_argument("--operations", type=int, default=100,
+                      help="transactions per client")
+    load.add_argument("--max-batch", type=int, nargs="+", default=[1, 16, 256])
+    load.add_argument("--max-delay", type=float, default=0,
+                      help="seconds the writer waits to fill a batch")
+
+    indexed = commands.add_parser("indexes", help="hot query latency with and without indexes")
+    indexed.add_argument("--transactions", type=int, default=10_000_000)
+    indexed.add_argument("--accounts", type=int, default=100_000)
+    indexed.add_argument("--banks", type=int, default=100)
+    indexed.add_argument("--lookups", type=int, default=1_000)
+    indexed.add_argument("--scan-lookups", type=int, default=5,
+                         help="lookups to run without the indexes")
+
+    statement = commands.add_parser("statements", help="month-end statement throughput")
+    statement.add_argument("--accounts", type=int, default=100_000)
+    statement.add_argument("--transactions", type=int, default=2_000_000,
+                           help="transactions over two months, the second being the statement month")
+    statement.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    statement.add_argument("--orm-max", type=int, default=5_000,
+                           help="accounts to write through sort_transactions for the baseline")
+
+    replaying = commands.add_parser("replay", help="ledger replay throughput and memory")
+    replaying.add_argument("--transactions", type=int, default=10_000_000,
+                           help="the log to replay; memory stays flat up to 100M and beyond")
+    replaying.add_argument("--accounts", type=int, default=100_000)
+    replaying.add_argument("--chunk-size", type=int, default=1_000_000)
+    replaying.add_argument("--appended", type=int, default=100_000,
+                           help="transactions added before the incremental replay")
+
+    reconciling = commands.add_parser("reconcile", help="ledger reconciliation throughput")
+    reconciling.add_argument("--accounts", type=int, default=100_000)
+    reconciling.add_argument("--transactions", type=int, default=10_000_000,
+                             help="customer transactions; month-end rows come on top")
+    reconciling.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    reconciling.add_argument("--orm-max", type=int, default=1_000,
+                             help="accounts to check through the ORM for the baseline")
+
+    sharded = commands.add_parser("shards", help="concurrent writers on one file and on shards")
+    sharded.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    sharded.add_argument("--workers", type=int, default=4)
+    sharded.add_argument("--accounts", type=int, default=1_000, help="accounts per shard")
+    sharded.add_argument("--operations", type=int, default=500,
+                         help="transactions per worker")
+
+    suite = commands.add_parser("suite", help="core operation latency on generated banks, saved as JSON")
+    suite.add_argument("--sizes", type=_suite_size, nargs="+",
+                       default=[(1_000, 100_000), (10_000, 1_000_000), (100_000, 10_000_000)],
+                       help="banks to time, as ACCOUNTS:TRANSACTIONS")
+    suite.add_argument("--samples", type=int, default=1_000, help="calls to time per operation")
+    suite.add_argument("--seed", type=int, default=0)
+    suite.add_argument("--data-dir", default="bench-data", help="where the generated banks are kept")
+    suite.add_argument("--out", default="bench-results.json")
+    suite.add_argument("--compare", help="an earlier results file to compare with")
+
+    args = parser.parse_args()
+    if args.benchmark == "find_account":
+        bench_find_account(args.sizes, args.lookups, args.scan_max)
+    elif args.benchmark == "check_limits":
+        bench_check_limits(args.histories, args.checks)
+    elif args.benchmark == "import":
+        bench_import(args.rows, args.accounts, args.chunk_size, args.single_rows)
+    elif args.benchmark == "logging":
+        bench_logging(args.transactions)
+    elif args.benchmark == "stress":
+        bench_stress(args.workers, args.accounts, args.operations)
+    elif args.benchmark == "open_accounts":
+        bench_open_accounts(args.workers, args.accounts, args.block_size, args.chunk_size)
+    elif args.benchmark == "ledger_memory":
+        bench_ledger_memory(args.transactions, args.accounts, args.orm_max)
+    elif args.benchmark == "month_end":
+        bench_month_end(args.accounts, args.scalar_max, args.chunk_size)
+    elif args.benchmark == "group_commit":
+        bench_group_commit(args.writes, args.batch_sizes, args.concurrent)
+    elif args.benchmark == "startup":
+        bench_startup(args.accounts, args.runs)
+    elif args.benchmark == "async_load":
+        bench_async_load(args.clients, args.accounts, args.operations, args.max_batch, args.max_delay)
+    elif args.benchmark == "indexes":
+        bench_indexes(args.transactions, args.accounts, args.banks, args.lookups, args.scan_lookups)
+    elif args.benchmark == "statements":
+        bench_statements(args.accounts, args.transactions, args.workers, args.orm_max)
+    elif args.benchmark == "replay":
+        bench_replay(args.transactions, args.accounts, args.chunk_size, args.appended)
+    elif args.benchmark == "reconcile":
+        bench_reconcile(args.accounts, args.transactions, args.workers, args.orm_max)
+    elif args.benchmark == "shards":
+        bench_shards(args.shards, args.workers, args.accounts, args.operations)
+    elif args.benchmark == "suite":
+        bench_suite(args.sizes, args.samples, args.seed, args.data_dir, args.out, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""Generate a synthetic bank.db for benchmarks, reproducibly from a seed.
+
+    python datagen.py bank.db --accounts 100000 --transactions 10000000 [--seed N]
+
+The bank follows the same rules as the models: no withdrawal overdraws
+its account, savings accounts stay within two transactions a day and five
+a month, and every account has interest and fees assessed once at each
+month end from the month it opened, with the checking low balance fee.
+The last month is left open, so month_end.py has a month to assess.
+Balances, latest dates and the running balance of every transaction are
+consistent, so a generated bank reconciles cleanly.
+
+To look like real traffic, the activity per account is heavy-tailed, so
+a few accounts have most of the transactions. There are fewer
+transactions at weekends and more on paydays (the 1st and the 15th), and
+deposits and withdrawals have log-normal amounts. --transactions counts
+the customer transactions; interest and fee rows come on top. Savings
+accounts take a little less than their share, since dates that would
+break their limits are dropped.
+
+Accounts are generated in id order and written with bulk inserts of
+about half a million transactions at a time, so memory stays bounded and
+the (account, date) index is filled in order. The same seed and sizes always give the same file.
+"""
+
+import argparse
+import bisect
+import datetime
+import math
+import os
+import random
+from collections import Counter
+
+import sqlalchemy
+
+from account import CheckingAccount, SavingsAccount
+from migrate import prepare
+
+
+def _day_weights(first, last):
+    """Relative activity of each day from first to last."""
+    weights = []
+    day = first
+    while day <= last:
+        weight = (1.0, 1.0, 1.0, 1.0, 1.0, 0.5, 0.3)[day.weekday()]
+        if day.day in (1, 15):
+            weight *= 2
+        weights.append(weight)
+        day += datetime.timedelta(days=1)
+    return weights
+
+
+def _month_ends(first, last):
+    """The ordinals of the last days of the months from first's month up to
+    the one before last's."""
+    ends = []
+    month = first.replace(day=1)
+    while month < last.replace(day=1):
+        following = (month + datetime.timedelta(days=31)).replace(day=1)
+        ends.append(following.toordinal() - 1)
+        month = following
+    return ends
+
+
+class _Generator:
+    """Builds the rows of one account at a time from a shared random stream."""
+
+    def __init__(self, rng, first, last):
+        self._rng = rng
+        self._ordinals = list(range(first.toordinal(), last.toordinal() + 1))
+        self._cumulative = list(_accumulate(_day_weights(first, last)))
+        self._iso = {o: datetime.date.fromordinal(o).isoformat() for o in self._ordinals}
+        self._month_ends = _month_ends(first, last)
+        self._rates = {
+            "Checking": int(CheckingAccount()._interest_rate.scaleb(6)),
+            "Savings": int(SavingsAccount()._interest_rate.scaleb(6)),
+        }
+        self._fee_below = int(CheckingAccount._low_balance.scaleb(2))
+        self._fee = int(CheckingAccount._low_balance_fee.scaleb(2))
+
+    def account(self, account_id, bank_id, kind, count, transactions):
+        """Append the rows of a kind ("Checking" or "Savings") account with
+        count customer transactions to transactions and return its
+        account row."""
+        rng = self._rng
+        rate = self._rates[kind]
+        dates = sorted(rng.choices(self._ordinals, cum_weights=self._cumulative, k=count))
+        if kind == "Savings":
+            dates = _within_limits(dates)
+
+        month_ends = self._month_ends
+        next_end = bisect.bisect_left(month_ends, dates[0])
+        balance = 0
+        latest = dates[0]
+        for i, ordinal in enumerate(dates):
+            while next_end < len(month_ends) and month_ends[next_end] < ordinal:
+                balance = self._month_end(account_id, kind, rate, balance, month_ends[next_end], transactions)
+                latest = month_ends[next_end]
+                next_end += 1
+
+            # log-normal dollar amounts, drawn as exp(gauss), which is cheaper
+            if i == 0:
+                amount = _cents(math.exp(rng.gauss(6.2, 1.0)))  # opening deposit, around $500
+            elif rng.random() < 0.55:
+                amount = _cents(math.exp(rng.gauss(4.4, 1.0)))  # around $80
+            else:
+                amount = -_cents(math.exp(rng.gauss(3.9, 1.0)))  # around $50
+                if balance <= -amount:
+                    amount = -amount  # refused; a deposit instead
+            balance += amount
+            latest = ordinal
+            transactions.append((account_id, self._iso[ordinal], amount, 0, balance))
+
+        for end in month_ends[next_end:]:
+            balance = self._month_end(account_id, kind, rate, balance, end, transactions)
+            latest = end
+        return (account_id, bank_id, balance, self._iso[latest], rate, kind)
+
+    def _month_end(self, account_id, kind, rate, balance, ordinal, transactions):
+        """Append interest, and the checking low balance fee, as
+        assess_interest_and_fees would. Returns the new balance."""
+        product = balance * rate
+        interest = (abs(product) + 500_000) // 1_000_000
+        if product < 0:
+            interest = -interest
+        balance += interest
+        date = self._iso[ordinal]
+        transactions.append((account_id, date, interest, 1, balance))
+        if kind == "Checking" and balance < self._fee_below:
+            balance += self._fee
+            transactions.append((account_id, date, self._fee, 1, balance))
+        return balance
+
+
+def _accumulate(values):
+    total = 0.0
+    for value in values:
+        total += value
+        yield total
+
+
+def _cents(dollars):
+    cents = int(dollars * 100)
+    return cents if cents > 0 else 1
+
+
+def _within_limits(ordinals):
+    """Drop the dates that would take a savings account past two
+    transactions a day or five a month."""
+    kept = []
+    days = Counter()
+    months = Counter()
+    for ordinal in ordinals:
+        date = datetime.date.fromordinal(ordinal)
+        month = (date.year, date.month)
+        if days[ordinal] < 2 and months[month] < 5:
+            days[ordinal] += 1
+            months[month] += 1
+            kept.append(ordinal)
+    return kept
+
+
+def _activity(rng, accounts, transactions, savings_share, savings_cap):
+    """The type and number of customer transactions of every account.
+    Activity is heavy-tailed, at least one each (the opening deposit), and
+    adds up to about transactions. Savings accounts are held to half of
+    savings_cap, and what they cannot take goes to the checking accounts."""
+    kinds = ["Savings" if rng.random() < savings_share else "Checking" for _ in range(accounts)]
+    weights = [rng.paretovariate(1.5) for _ in range(accounts)]
+    extra = max(transactions - accounts, 0)
+    scale = extra / sum(weights)
+    limit = savings_cap // 2
+    savings = sum(min(w * scale, limit) for w, kind in zip(weights, kinds) if kind == "Savings")
+    checking = sum(w for w, kind in zip(weights, kinds) if kind == "Checking")
+    checking_scale = (extra - savings) / checking if checking else 0
+    return [(kind, 1 + int(min(w * scale, limit) if kind == "Savings" else w * checking_scale))
+            for kind, w in zip(kinds, weights)]
+
+
+def _insert(conn, account_rows, transaction_rows):
+    conn.exec_driver_sql(
+        "INSERT INTO account (_id, _bank_id, _balance, latest_date, _interest_rate, type) "
+        "VALUES (?, ?, ?, ?, ?, ?)", account_rows)
+    conn.exec_driver_sql(
+        'INSERT INTO "transaction" (_account_id, _creation_date, _amount, _interest_flag, '
+        "_balance_after) VALUES (?, ?, ?, ?, ?)", transaction_rows)
+    return len(transaction_rows)
+
+
+def generate(url, accounts, transactions, seed=0, savings_share=0.4,
+             first=datetime.date(2020, 1, 1), last=datetime.date(2024, 12, 31), chunk_size=500_000):
+    """Create a bank at url, which must not have one yet, with the given
+    number of accounts and about the given number of customer transactions.
+    Rows are inserted whenever chunk_size transactions have been built.
+    Returns the number of transaction rows written, month ends included."""
+    engine = sqlalchemy.create_engine(url)
+    prepare(engine)
+    rng = random.Random(seed)
+    months = (last.year - first.year) * 12 + last.month - first.month + 1
+    activity = _activity(rng, accounts, transactions, savings_share, 5 * months)
+    generator = _Generator(rng, first, last)
+
+    written = 0
+    with engine.begin() as conn:
+        # a throwaway file being filled from scratch needs no crash safety
+        conn.exec_driver_sql("PRAGMA synchronous=OFF")
+        if conn.exec_driver_sql("SELECT count(*) FROM account").scalar():
+            raise ValueError(f"{url} already has accounts")
+        conn.exec_driver_sql("INSERT INTO bank (_id) VALUES (1)")
+        account_rows = []
+        transaction_rows = []
+        for i, (kind, count) in enumerate(activity):
+            account_rows.append(generator.account(i + 1, 1, kind, count, transaction_rows))
+            if len(transaction_rows) >= chunk_size or i == accounts - 1:
+                written += _insert(conn, account_rows, transaction_rows)
+                account_rows = []
+                transaction_rows = []
+    engine.dispose()
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic bank database.")
+    parser.add_argument("database", help="the file to create")
+    parser.add_argument("--accounts", type=int, default=1_000)
+    parser.add_argument("--transactions", type=int, default=100_000,
+                        help="customer transactions, before interest and fees")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--savings", type=float, default=0.4, help="share of savings accounts")
+    parser.add_argument("--first", type=datetime.date.fromisoformat, default=datetime.date(2020, 1, 1))
+    parser.add_argument("--last", type=datetime.date.fromisoformat, default=datetime.date(2024, 12, 31))
+    args = parser.parse_args()
+
+    if os.path.exists(args.database):
+        parser.error(f"{args.database} already exists")
+    written = generate(f"sqlite:///{args.database}", args.accounts, args.transactions,
+                       args.seed, args.savings, args.first, args.last)
+    print(f"{args.database}: {args.accounts} accounts, {written} transactions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Engines for bank.db.
+
+With concurrent=True several processes (tellers, batch jobs) can share
+one database file: it runs in WAL mode so readers never block the
+writer and a writer never blocks readers, and waits busy_timeout ms for
+a lock instead of failing.
+
+Transactions that only read start with a plain BEGIN and take no lock.
+A unit of work that writes calls begin_write(session) first, so its
+transaction starts with BEGIN IMMEDIATE: the write lock is taken before
+anything is read, the transaction works on current data and two writers
+cannot interleave. (A deferred transaction that reads and then writes
+would fail with "database is locked" if another writer committed in
+between.) An engine made with immediate=True, for batch jobs that do
+nothing but write, starts every transaction that way. Sessions should be
+committed before waiting on a user, to let go of the lock.
+"""
+
+import sqlalchemy
+from sqlalchemy import event
+
+
+def create_engine(url="sqlite:///bank.db", concurrent=False, busy_timeout=30000, pool_size=5,
+                  immediate=False):
+    """Returns an engine for url, set up for several processes if concurrent,
+    with every transaction taking the write lock if immediate."""
+    if not concurrent:
+        return sqlalchemy.create_engine(url)
+
+    engine = sqlalchemy.create_engine(url, pool_size=pool_size, max_overflow=pool_size,
+                                      connect_args={"timeout": busy_timeout / 1000})
+    configure_concurrent(engine, busy_timeout, immediate)
+    return engine
+
+
+def begin_write(session):
+    """Start the session's next transaction with BEGIN IMMEDIATE, for a unit
+    of work that writes. An open transaction that has not taken the write
+    lock is committed first, so call it before the unit of work, not in
+    the middle of one. Does nothing on an engine that is not concurrent."""
+    if session.in_transaction():
+        if session.connection().get_execution_options().get("immediate"):
+            return
+        session.commit()
+    session.connection(execution_options={"immediate": True})
+
+
+def configure_concurrent(engine, busy_timeout=30000, immediate=False):
+    """Sets up the pragmas and transaction begins on a synchronous engine,
+    or on the sync_engine of an asyncio one."""
+
+    @event.listens_for(engine, "connect")
+    def _connect(dbapi_connection, connection_record):
+        # SQLAlchemy begins transactions itself, see _begin
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout)}")
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def _begin(conn):
+        if immediate or conn.get_execution_options().get("immediate"):
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        else:
+            conn.exec_driver_sql("BEGIN")
@@ -0,0 +1,21 @@
+"""The errors raised by accounts, importable without loading the models."""
+
+
+class OverdrawError(Exception):
+    pass
+
+class TransactionLimitError(Exception):
+    pass
+    
+
+class TransactionSequenceError(Exception):
+    def __init__(self, date):
+        self.latest_date = date
+
+
+class JournalInUseError(Exception):
+    """Another teller's GroupCommitter has the journal file open."""
+
+    def __init__(self, journal):
+        super().__init__(f"{journal} is in use by another teller")
+        self.journal = journal
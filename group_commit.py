@@ -0,0 +1,222 @@
+"""Commit a teller's writes in groups instead of one at a time.
+
+Every write goes through GroupCommitter.write as a named operation. It is
+applied to the session straight away, so it is checked against the
+account as usual, but the session is only committed once max_ops writes
+are pending or the oldest of them is max_delay seconds old, or on an
+explicit flush(). The age is checked by flush_if_due, so a caller that
+blocks, e.g. on the teller's input, should wait at most due_in()
+seconds and call it. Meanwhile each write is appended to a journal file
+and fsynced before write returns, so a write that has been acknowledged
+survives a crash even before its group is committed: the next
+GroupCommitter on the same journal replays whatever the database is
+missing.
+
+The database records the last journaled write it has committed in the
+journal_mark table, in the same transaction as the writes themselves,
+so replay knows where to start whether the crash came before or after
+the commit. Each teller needs a journal file of its own: a GroupCommitter
+holds an exclusive lock on its journal (where the platform has flock)
+and raises JournalInUseError if another one already has it.
+
+Each group is one write transaction, begun with db.begin_write, so while
+writes are pending the session holds the database's write lock, and
+batching suits a single busy teller rather than many sharing bank.db.
+"""
+
+from decimal import *
+import datetime
+import json
+import logging
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from sqlalchemy import Column, Integer, String
+
+from account import OverdrawError
+from account import TransactionLimitError
+from account import TransactionSequenceError
+from errors import JournalInUseError
+from transaction import Base
+import db
+import metrics
+
+getcontext().rounding = ROUND_HALF_UP
+
+
+class JournalMark(Base):
+    """The last journaled write committed to the database, per journal."""
+
+    __tablename__ = "journal_mark"
+
+    _journal = Column(String, primary_key=True)
+    _seq = Column(Integer)
+
+
+def _open_account(committer, account_type):
+    return committer._bank.new_account(account_type, committer._session)
+
+
+def _add_transaction(committer, account, amount, date):
+    account = committer._find(account)
+    account.add_transaction(Decimal(amount), datetime.date.fromisoformat(date), committer._session)
+    return account
+
+
+def _assess_interest_and_fees(committer, account):
+    account = committer._find(account)
+    account.assess_interest_and_fees(committer._session)
+    return account
+
+
+OPERATIONS = {
+    "open_account": _open_account,
+    "add_transaction": _add_transaction,
+    "assess_interest_and_fees": _assess_interest_and_fees,
+}
+
+
+class GroupCommitter:
+    """Applies writes to session and commits them in groups.
+
+    With journal=None nothing is journaled and the writes are only as
+    safe as their commits; max_ops=1 then commits every write at once."""
+
+    def __init__(self, session, bank, journal="bank.journal", max_ops=100, max_delay=1.0):
+        self._session = session
+        self._bank = bank
+        self._journal = journal
+        self._max_ops = max_ops
+        self._max_delay = max_delay
+        self._pending = 0
+        self._since = None
+        self._seq = 0
+        self._ids = {}  # journaled account id -> id the account got on replay
+        self._file = None
+
+        if journal is not None:
+            self._file = open(journal, "a")
+            self._lock()
+            db.begin_write(session)
+            mark = session.get(JournalMark, journal)
+            if mark is None:
+                mark = JournalMark(_journal=journal, _seq=0)
+                session.add(mark)
+            self._mark = mark
+            self._seq = mark._seq
+            self._recover()
+
+    @property
+    def pending(self):
+        """The number of writes not yet committed."""
+        return self._pending
+
+    def write(self, operation, **args):
+        """Apply one of the OPERATIONS and journal it. Returns the account
+        it wrote to. The bank's errors propagate and nothing is journaled."""
+        args = {name: str(value) for name, value in args.items()}
+        if not self._pending:
+            db.begin_write(self._session)
+        result = OPERATIONS[operation](self, **args)
+
+        if self._file is not None:
+            self._seq += 1
+            entry = {"seq": self._seq, "op": operation, "args": args}
+            if operation == "open_account":
+                entry["id"] = result.get_id()
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            with metrics.timer("fsync", "journal"):
+                os.fsync(self._file.fileno())
+
+        self._pending += 1
+        if self._since is None:
+            self._since = time.monotonic()
+        if self._pending >= self._max_ops:
+            self.flush()
+        return result
+
+    def due_in(self):
+        """Seconds until the oldest pending write is max_delay old, or None
+        if nothing is pending."""
+        if self._since is None:
+            return None
+        return max(0.0, self._since + self._max_delay - time.monotonic())
+
+    def flush_if_due(self):
+        """Commit the pending writes if the oldest has waited max_delay."""
+        if self._since is not None and time.monotonic() - self._since >= self._max_delay:
+            self.flush()
+
+    def flush(self):
+        """Commit the pending writes now and empty the journal."""
+        if self._file is not None:
+            self._mark._seq = self._seq
+        self._session.commit()
+        logging.debug("Saved to bank.db")
+        if self._file is not None:
+            self._file.truncate(0)
+            with metrics.timer("fsync", "journal"):
+                os.fsync(self._file.fileno())
+        self._pending = 0
+        self._since = None
+
+    def close(self):
+        """Commit anything pending and close the journal."""
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _lock(self):
+        """Take an exclusive lock on the journal, held until it is closed."""
+        if fcntl is None:
+            return  # no flock on Windows
+        try:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._file.close()
+            self._file = None
+            raise(JournalInUseError(self._journal))
+
+    def _find(self, account_id):
+        account = self._bank.find_account(self._ids.get(account_id, account_id), self._session)
+        if account is None:
+            raise AttributeError(f"no account {account_id}")
+        return account
+
+    def _recover(self):
+        """Replay the journaled writes the database has not committed."""
+        with open(self._journal) as f:
+            lines = f.readlines()
+
+        replayed = 0
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break  # torn by the crash, so never acknowledged
+            if entry["seq"] <= self._seq:
+                continue
+            try:
+                result = OPERATIONS[entry["op"]](self, **entry["args"])
+            except (AttributeError, OverdrawError, TransactionLimitError, TransactionSequenceError) as e:
+                logging.error("Could not replay journal entry %s: %s", entry["seq"], type(e).__name__)
+            else:
+                if entry["op"] == "open_account":
+                    self._ids[str(entry["id"])] = result.get_id()
+                replayed += 1
+            self._seq = entry["seq"]
+
+        if replayed:
+            logging.warning("Replayed %s writes from %s", replayed, self._journal)
+        self._mark._seq = self._seq
+        self._session.commit()
+        self._ids.clear()
+        with open(self._journal, "w") as f:
+            os.fsync(f.fileno())
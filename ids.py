@@ -0,0 +1,46 @@
+"""Blocks of account ids reserved in the database.
+
+Account ids come from the account table's AUTOINCREMENT counter in
+sqlite_sequence. An IdAllocator moves that counter forward by a whole
+block at a time and hands the ids out from memory, so processes opening
+accounts in bulk take the counter once per block instead of flushing
+once per account, and never collide with each other or with ids the
+database assigns itself.
+"""
+
+from sqlalchemy import event, text
+
+
+class IdAllocator:
+    """Hands out account ids for one session, reserving block_size at a time.
+
+    A block is reserved inside the session's transaction. If that
+    transaction is rolled back the reservation is undone too, so the
+    allocator drops whatever is left of its block."""
+
+    def __init__(self, session, block_size=1000):
+        self._session = session
+        self._block_size = block_size
+        self._next = 0
+        self._end = 0
+        event.listen(session, "after_rollback", self._discard)
+
+    def next_id(self):
+        if self._next == self._end:
+            self._reserve()
+        self._next += 1
+        return self._next - 1
+
+    def _reserve(self):
+        self._session.execute(text(
+            "INSERT INTO sqlite_sequence (name, seq) "
+            "SELECT 'account', (SELECT coalesce(max(_id), 0) FROM account) "
+            "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'account')"))
+        end = self._session.execute(text(
+            "UPDATE sqlite_sequence SET seq = seq + :size WHERE name = 'account' RETURNING seq"),
+            {"size": self._block_size}).scalar()
+        self._next = end - self._block_size + 1
+        self._end = end + 1
+
+    def _discard(self, session):
+        self._next = self._end = 0
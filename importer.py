@@ -0,0 +1,53 @@
+"""Import a settlement file of transactions into bank.db.
+
+The file is a CSV with an account_id,amount,date header and one
+transaction per line, dates as YYYY-MM-DD. It is streamed, so files of
+any size can be imported:
+
+    python importer.py settlement.csv [--chunk-size N]
+"""
+
+import argparse
+import csv
+import sys
+
+from sqlalchemy.orm.session import sessionmaker
+
+from bank import Bank
+from migrate import prepare
+import banklog
+import db
+
+
+def read_csv(file):
+    """Yield (account_id, amount, date) string tuples from an open CSV file."""
+    for row in csv.DictReader(file):
+        yield row["account_id"], row["amount"], row["date"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import a settlement CSV file into bank.db.")
+    parser.add_argument("file")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    banklog.configure()
+    # tellers may keep writing; each chunk takes the write lock in turn
+    engine = db.create_engine(f"sqlite:///bank.db", concurrent=True)
+    prepare(engine)
+    session = sessionmaker(bind=engine)()
+
+    bank = session.query(Bank).first()
+    if not bank:
+        sys.exit("bank.db has no bank to import into")
+
+    with open(args.file, newline="") as f:
+        report = bank.import_transactions(read_csv(f), session, args.chunk_size)
+
+    print(report)
+    for row, reason in report.rejected:
+        print(f"row {row}: {reason}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""Latency metrics for the bank, switched on once at startup with configure().
+
+Until then nothing is recorded and an instrumented call costs one global
+lookup. Once configured, every observation lands in a histogram keyed by
+kind and name:
+
+    operation   the model methods decorated with timed(), e.g.
+                add_transaction or find_account
+    sql         statements sent to the database, by their first keyword,
+                once instrument() has hooked the engine
+    commit      "database" is the COMMIT itself, including SQLite's fsync;
+                "session" is Session.commit(), which flushes first
+    fsync       "journal" is GroupCommitter's journal fsync
+
+A background thread rewrites the dump file every interval seconds and at
+exit, as JSON or, for a .prom file, in the Prometheus text format.
+"""
+
+import atexit
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+           0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = None
+_writer = None
+_pid = None
+
+
+class Histogram:
+    """Counts of observations per bucket, plus their count, sum and max."""
+
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """The upper bound of the bucket holding the q quantile, capped at
+        the largest observation."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Registry:
+    """Histograms by (kind, name). Observations may come from any thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._started = time.time()
+
+    def observe(self, kind, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get((kind, name))
+            if histogram is None:
+                histogram = self._histograms[(kind, name)] = Histogram()
+            histogram.observe(seconds)
+
+    def snapshot(self):
+        """The histograms as a dict, ready for json.dumps."""
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            result = {"time": time.time(), "uptime": time.time() - self._started,
+                      "buckets": list(BUCKETS) + ["+Inf"]}
+            for (kind, name), h in histograms:
+                result.setdefault(kind, {})[name] = {
+                    "count": h.count,
+                    "sum": h.sum,
+                    "mean": h.sum / h.count,
+                    "p50": h.quantile(0.5),
+                    "p90": h.quantile(0.9),
+                    "p99": h.quantile(0.99),
+                    "max": h.max,
+                    "buckets": h.counts[:],
+                }
+        return result
+
+    def prometheus(self):
+        """The histograms in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            kind = None
+            for (k, name), h in histograms:
+                metric = f"bank_{k}_seconds"
+                if k != kind:
+                    kind = k
+                    lines.append(f"# TYPE {metric} histogram")
+                label = name.replace("\\", "\\\\").replace('"', '\\"')
+                cumulative = 0
+                for bound, count in zip(BUCKETS, h.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{name="{label}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{name="{label}",le="+Inf"}} {h.count}')
+                lines.append(f'{metric}_sum{{name="{label}"}} {h.sum}')
+                lines.append(f'{metric}_count{{name="{label}"}} {h.count}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, filename):
+        """Write the metrics to filename, replacing it in one step so a
+        reader never sees a partial dump."""
+        if filename.endswith(".prom"):
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.snapshot(), indent=1)
+        partial = filename + ".tmp"
+        with open(partial, "w") as f:
+            f.write(text)
+        os.replace(partial, filename)
+
+
+class _Writer(threading.Thread):
+    """Dumps the registry every interval seconds until stopped."""
+
+    def __init__(self, registry, filename, interval):
+        super().__init__(daemon=True)
+        self._registry = registry
+        self._filename = filename
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            self._registry.dump(self._filename)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self._registry.dump(self._filename)
+
+
+def configure(filename="bank-metrics.json", interval=10.0):
+    """Start recording and dump to filename every interval seconds and at
+    exit. Calling it again in the same process does nothing."""
+    global _registry, _writer, _pid
+    if _writer is not None and _pid == os.getpid():
+        return
+    _registry = Registry()
+    _writer = _Writer(_registry, filename, interval)
+    _writer.start()
+    _pid = os.getpid()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Write a final dump and stop recording."""
+    global _registry, _writer
+    if _writer is None or _pid != os.getpid():
+        return
+    _writer.stop()
+    _registry = None
+    _writer = None
+
+
+def enabled():
+    return _registry is not None
+
+
+def observe(kind, name, seconds):
+    """Record one observation, if metrics are on."""
+    registry = _registry
+    if registry is not None:
+        registry.observe(kind, name, seconds)
+
+
+class timer:
+    """Context manager that records how long its block took."""
+
+    __slots__ = ("_kind", "_name", "_start")
+
+    def __init__(self, kind, name):
+        self._kind = kind
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        observe(self._kind, self._name, time.perf_counter() - self._start)
+
+
+def timed(name):
+    """Decorator recording each call's latency as the operation name."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            registry = _registry
+            if registry is None:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                registry.observe("operation", name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def instrument(engine):
+    """Record the statements and commits of engine and of the sessions
+    bound to it. Does nothing unless metrics are on."""
+    if _registry is None:
+        return
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["metrics_started"].pop()
+        keyword = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "?"
+        observe("sql", keyword, time.perf_counter() - started)
+
+    # the dialect has no commit event that fires afterwards, so its
+    # do_commit is wrapped for this engine
+    do_commit = engine.dialect.do_commit
+
+    def _do_commit(dbapi_connection):
+        with timer("commit", "database"):
+            do_commit(dbapi_connection)
+
+    engine.dialect.do_commit = _do_commit
+
+    @event.listens_for(Session, "before_commit")
+    def _before_commit(session):
+        if session.bind is engine:
+            session.info["metrics_commit"] = time.perf_counter()
+
+    @event.listens_for(Session, "after_commit")
+    def _after_commit(session):
+        started = session.info.pop("metrics_commit", None)
+        if started is not None:
+            observe("commit", "session", time.perf_counter() - started)
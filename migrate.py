@@ -0,0 +1,194 @@
+"""Create bank.db or bring an existing one up to the current schema in place.
+
+    python migrate.py [path/to/bank.db] [--chunk-size N]
+
+The schema version is kept in SQLite's PRAGMA user_version. Each step
+runs in its own transaction together with the version bump, so an
+interrupted migration leaves the database at the previous version.
+"""
+
+import argparse
+from decimal import *
+
+import sqlalchemy
+from sqlalchemy import event, inspect, text
+from sqlalchemy.schema import CreateTable
+
+from transaction import Base
+import bank  # registers the account and bank tables on Base.metadata
+import group_commit  # and journal_mark
+import replay  # and the replay checkpoint tables
+
+getcontext().rounding = ROUND_HALF_UP
+
+SCHEMA_VERSION = 6
+
+
+def _money_to_fixed_point(conn, chunk_size):
+    """Version 1: store balances, rates and amounts as fixed point integers
+    instead of floats. Rows are streamed from the old table into a rebuilt
+    one, rounding half up to the column's scale."""
+    columns = {"account": ["_balance", "_interest_rate"], "transaction": ["_amount"]}
+    for name, money in columns.items():
+        declared = {c["name"]: str(c["type"]) for c in inspect(conn).get_columns(name)}
+        if declared[money[0]] != "FLOAT":
+            continue
+
+        def convert(row):
+            row = dict(row)
+            for column in money:
+                if row[column] is not None:
+                    row[column] = Decimal(repr(row[column]))
+            return row
+
+        _rebuild_table(conn, Base.metadata.tables[name], convert, chunk_size, raw=money)
+
+
+def _running_balances(conn, chunk_size):
+    """Version 2: keep the account balance after each transaction on the
+    transaction row, filled in from the existing log."""
+    from ledger import rebuild_running_balances  # ledger imports this module
+
+    columns = [c["name"] for c in inspect(conn).get_columns("transaction")]
+    if "_balance_after" not in columns:
+        conn.execute(text('ALTER TABLE "transaction" ADD COLUMN _balance_after BIGINT'))
+    rebuild_running_balances(conn, chunk_size)
+
+
+def _autoincrement_account_ids(conn, chunk_size):
+    """Version 3: let the database assign account ids from an AUTOINCREMENT
+    counter, which IdAllocator also reserves blocks from."""
+    sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE name = 'account'")).scalar()
+    if "AUTOINCREMENT" not in sql:
+        _rebuild_table(conn, Base.metadata.tables["account"], dict, chunk_size)
+
+
+def _journal_marks(conn, chunk_size):
+    """Version 4: add the journal_mark table for group commit journals."""
+    group_commit.JournalMark.__table__.create(conn, checkfirst=True)
+
+
+def _hot_path_indexes(conn, chunk_size):
+    """Version 5: index accounts by bank, and bring the other account and
+    transaction indexes in line with the model."""
+    for table in (Base.metadata.tables["account"], Base.metadata.tables["transaction"]):
+        existing = {index["name"]: index["column_names"] for index in inspect(conn).get_indexes(table.name)}
+        for index in table.indexes:
+            columns = [column.name for column in index.columns]
+            if existing.get(index.name) == columns:
+                continue
+            if index.name in existing:
+                conn.execute(text(f'DROP INDEX "{index.name}"'))
+            index.create(conn)
+
+
+def _replay_checkpoints(conn, chunk_size):
+    """Version 6: add the ledger_checkpoint and replay_mark tables. They
+    start empty, so the first replay reads the whole log."""
+    replay.Checkpoint.__table__.create(conn, checkfirst=True)
+    replay.ReplayMark.__table__.create(conn, checkfirst=True)
+
+
+STEPS = [_money_to_fixed_point, _running_balances, _autoincrement_account_ids, _journal_marks,
+         _hot_path_indexes, _replay_checkpoints]
+
+
+def _rebuild_table(conn, table, convert, chunk_size, raw=()):
+    """Replace a table with one created from its current definition, streaming
+    every row through convert on the way. Columns named in raw are read as
+    stored rather than through their current type."""
+    metadata = sqlalchemy.MetaData()
+    for other in table.metadata.tables.values():
+        other.to_metadata(metadata)  # so foreign keys still resolve
+    new = table.to_metadata(metadata, name=f"{table.name}_new")
+    conn.execute(CreateTable(new))
+
+    # columns added by later steps do not exist yet and are left empty
+    existing = {c["name"] for c in inspect(conn).get_columns(table.name)}
+    columns = [column for column in table.columns if column.name in existing]
+    select = text(f'SELECT {", ".join(c.name for c in columns)} FROM "{table.name}" ORDER BY rowid').columns(
+        **{column.name: column.type for column in columns if column.name not in raw})
+    result = conn.execute(select).mappings()
+    for rows in result.partitions(chunk_size):
+        conn.execute(new.insert(), [convert(row) for row in rows])
+
+    conn.execute(text(f'DROP TABLE "{table.name}"'))
+    conn.execute(text(f'ALTER TABLE "{new.name}" RENAME TO "{table.name}"'))
+    for index in table.indexes:
+        index.create(conn)
+
+
+def schema_version(conn):
+    return conn.execute(text("PRAGMA user_version")).scalar()
+
+
+def _set_schema_version(conn, version):
+    conn.execute(text(f"PRAGMA user_version = {int(version)}"))
+
+
+def migrate(url, chunk_size=10000):
+    """Run every migration step the database at url has not had yet.
+    Returns the version it started at."""
+    engine = sqlalchemy.create_engine(url)
+
+    # let SQLite transactions cover the DDL as well (pysqlite only opens
+    # them implicitly before DML)
+    @event.listens_for(engine, "connect")
+    def _connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def _begin(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    try:
+        with engine.connect() as conn:
+            start = schema_version(conn)
+        for version in range(start, SCHEMA_VERSION):
+            with engine.begin() as conn:
+                if schema_version(conn) == version:
+                    STEPS[version](conn, chunk_size)
+                    _set_schema_version(conn, version + 1)
+    finally:
+        engine.dispose()
+    return start
+
+
+def prepare(engine):
+    """Create the tables of a new database at the current schema version,
+    or migrate an existing one. A database already at the current version
+    is left alone, which costs a single PRAGMA."""
+    with engine.begin() as conn:
+        if schema_version(conn) >= SCHEMA_VERSION:
+            return
+        if not inspect(conn).has_table("account"):
+            Base.metadata.create_all(conn)
+            _set_schema_version(conn, SCHEMA_VERSION)
+            return
+    migrate(engine.url)
+    Base.metadata.create_all(engine)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate a bank database to the current schema.")
+    parser.add_argument("database", nargs="?", default="bank.db")
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    engine = sqlalchemy.create_engine(f"sqlite:///{args.database}")
+    with engine.connect() as conn:
+        start = schema_version(conn) if inspect(conn).has_table("account") else None
+    if start is not None:
+        migrate(engine.url, args.chunk_size)
+    prepare(engine)
+
+    if start is None:
+        print(f"created {args.database} at schema version {SCHEMA_VERSION}")
+    elif start == SCHEMA_VERSION:
+        print(f"{args.database} is already at schema version {SCHEMA_VERSION}")
+    else:
+        print(f"migrated {args.database} from schema version {start} to {SCHEMA_VERSION}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+from decimal import *
+
+from sqlalchemy import BigInteger
+from sqlalchemy.types import TypeDecorator
+
+getcontext().rounding = ROUND_HALF_UP
+
+
+class FixedPoint(TypeDecorator):
+    """Stores a Decimal exactly as an integer count of 10**-scale units,
+    e.g. cents for scale=2, and hands it back as a Decimal.
+    Values with more places are rounded half up on the way in."""
+
+    impl = BigInteger
+    cache_ok = True
+
+    def __init__(self, scale=2):
+        super().__init__()
+        self.scale = scale
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return int(Decimal(value).scaleb(self.scale).to_integral_value(ROUND_HALF_UP))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return Decimal(value).scaleb(-self.scale)
+
+
+def cents(amount):
+    """Rounds an amount half up to whole cents as a Decimal. Ints are
+    accepted too, as add_transaction always has."""
+    return Decimal(amount).quantize(Decimal("0.01"), ROUND_HALF_UP)
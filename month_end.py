@@ -0,0 +1,220 @@
+"""Assess month-end interest and fees on every account in bank.db.
+
+Accounts are processed in id order, committing once per chunk, and can be
+split into id ranges handled by a pool of worker processes:
+
+    python month_end.py [--chunk-size N] [--workers N] [--vectorized] [--shards N]
+
+Accounts that already had interest applied for their month are skipped,
+so the job can safely be run again after an interruption.
+
+--vectorized computes a whole chunk at once with NumPy, on balances and
+rates in integer units, and writes the transactions and balances back in
+bulk. It needs numpy installed and gives the same results to the cent.
+
+--shards N runs on a bank sharded over bank-0.db ... bank-(N-1).db
+instead, a process per shard; see shards.py.
+"""
+
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import sqlalchemy
+from sqlalchemy import BigInteger, String, func, type_coerce
+from sqlalchemy.orm.session import sessionmaker
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from account import Account
+from account import CheckingAccount
+from account import TransactionSequenceError
+from bank import Bank
+from migrate import prepare
+from transaction import Transaction
+import banklog
+import db
+from workers import id_ranges, worker
+
+
+def run_month_end(session, bank_id, chunk_size=1000, first_id=None, last_id=None):
+    """Assess interest and fees on the bank's accounts with ids in
+    [first_id, last_id], one committed chunk at a time.
+    Returns the number of accounts assessed and skipped."""
+    assessed = 0
+    skipped = 0
+    after = first_id - 1 if first_id is not None else None
+    while True:
+        db.begin_write(session)
+        query = session.query(Account).filter(Account._bank_id == bank_id)
+        if after is not None:
+            query = query.filter(Account._id > after)
+        if last_id is not None:
+            query = query.filter(Account._id <= last_id)
+        accounts = query.order_by(Account._id).limit(chunk_size).all()
+        if not accounts:
+            session.commit()  # end the empty chunk's write transaction
+            break
+
+        for account in accounts:
+            try:
+                account.assess_interest_and_fees(session)
+                assessed += 1
+            except TransactionSequenceError:
+                skipped += 1
+        session.commit()
+        after = accounts[-1]._id
+
+        logging.debug("Month end through account: %s", after)
+
+    return assessed, skipped
+
+
+def run_month_end_vectorized(session, bank_id, chunk_size=100_000):
+    """run_month_end computed a chunk at a time with NumPy instead of one
+    Account at a time.
+
+    Balances are in cents and rates in millionths, so interest rounded
+    half up to the cent is exact integer arithmetic, and the checking fee
+    is a mask over the balances after interest. Returns the number of
+    accounts assessed and skipped."""
+    if numpy is None:
+        raise ImportError("the vectorized month end needs numpy")
+
+    table = Account.__table__
+    transactions = Transaction.__table__
+    month_end = type_coerce(
+        func.date(table.c.latest_date, "start of month", "+1 month", "-1 day"), String)
+    applied = sqlalchemy.exists().where(
+        transactions.c._account_id == table.c._id,
+        transactions.c._creation_date == month_end,
+        transactions.c._interest_flag == 1)
+
+    # money columns are read and written as stored, in integer units
+    query = sqlalchemy.select(
+        table.c._id, table.c.type,
+        type_coerce(table.c._balance, BigInteger),
+        type_coerce(table.c._interest_rate, BigInteger),
+        month_end,
+    ).where(table.c._bank_id == bank_id, ~applied)
+
+    fee_below = int(CheckingAccount._low_balance.scaleb(2))
+    fee = int(CheckingAccount._low_balance_fee.scaleb(2))
+    rate_unit = 10 ** table.c._interest_rate.type.scale
+
+    assessed = 0
+    after = None
+    while True:
+        db.begin_write(session)
+        chunk = query if after is None else query.where(table.c._id > after)
+        rows = session.execute(chunk.order_by(table.c._id).limit(chunk_size)).all()
+        if not rows:
+            break
+        ids, types, balances, rates, dates = zip(*rows)
+
+        balance = numpy.array(balances, dtype=numpy.int64)
+        product = balance * numpy.array(rates, dtype=numpy.int64)
+        interest = numpy.sign(product) * ((numpy.abs(product) + rate_unit // 2) // rate_unit)
+        balance += interest
+        with_interest = balance.tolist()
+        charged = numpy.flatnonzero((numpy.array(types) == "Checking") & (balance < fee_below))
+        balance[charged] += fee
+
+        # each account's interest row goes in before its fee row
+        rows = list(zip(ids, dates, interest.tolist(), with_interest))
+        rows += [(ids[i], dates[i], fee, balance[i].item()) for i in charged]
+        conn = session.connection()
+        conn.exec_driver_sql(
+            'INSERT INTO "transaction" (_account_id, _creation_date, _amount, _interest_flag, '
+            "_balance_after) VALUES (?, ?, ?, 1, ?)", rows)
+        conn.exec_driver_sql(
+            "UPDATE account SET _balance = ?, latest_date = ? WHERE _id = ?",
+            list(zip(balance.tolist(), dates, ids)))
+        session.commit()
+        assessed += len(ids)
+        after = ids[-1]
+
+        logging.debug("Month end through account: %s", after)
+
+    total = session.scalar(sqlalchemy.select(func.count()).where(table.c._bank_id == bank_id))
+    session.commit()  # end the last, empty chunk's write transaction
+    return assessed, total - assessed
+
+
+@worker
+def _run_range(url, bank_id, chunk_size, first_id, last_id):
+    """Worker process entry point: run one id range on its own engine."""
+    engine = db.create_engine(url, concurrent=True)
+    session = sessionmaker(bind=engine)()
+    try:
+        return run_month_end(session, bank_id, chunk_size, first_id, last_id)
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def run_month_end_parallel(url, bank_id, workers, chunk_size=1000):
+    """Split the bank's account ids into one range per worker and run them
+    in a process pool. Returns the total accounts assessed and skipped."""
+    engine = sqlalchemy.create_engine(url)
+    with engine.connect() as conn:
+        low, high = conn.execute(
+            sqlalchemy.select(func.min(Account._id), func.max(Account._id))
+            .where(Account._bank_id == bank_id)).one()
+    engine.dispose()
+    if low is None:
+        return 0, 0
+
+    ranges = id_ranges(low, high, workers)
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(_run_range, url, bank_id, chunk_size, first, last)
+                   for first, last in ranges]
+        results = [future.result() for future in futures]
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Assess month-end interest and fees on every account.")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--vectorized", action="store_true",
+                        help="compute with NumPy, a chunk at a time")
+    parser.add_argument("--shards", type=int, metavar="N",
+                        help="run on the N shards of a sharded bank, all at once")
+    args = parser.parse_args()
+
+    banklog.configure()
+    if args.shards:
+        # shards builds on this module, so it is only imported here
+        from shards import ShardedBank, shard_urls
+        bank = ShardedBank(shard_urls("bank.db", args.shards))
+        assessed, skipped = bank.run_month_end(args.chunk_size, args.vectorized)
+        bank.close()
+        print(f"assessed: {assessed}, already assessed: {skipped}")
+        return
+
+    url = f"sqlite:///bank.db"
+    engine = db.create_engine(url, concurrent=True)
+    prepare(engine)
+    session = sessionmaker(bind=engine)()
+    bank = session.query(Bank).first()
+    if not bank:
+        print("bank.db has no accounts")
+        return
+
+    if args.vectorized:
+        assessed, skipped = run_month_end_vectorized(session, bank._id, args.chunk_size)
+    elif args.workers > 1:
+        bank_id = bank._id
+        session.close()
+        assessed, skipped = run_month_end_parallel(url, bank_id, args.workers, args.chunk_size)
+    else:
+        assessed, skipped = run_month_end(session, bank._id, args.chunk_size)
+    print(f"assessed: {assessed}, already assessed: {skipped}")
+
+
+if __name__ == "__main__":
+    main()
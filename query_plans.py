@@ -0,0 +1,146 @@
+"""Check that the hot queries of the bank are answered through indexes.
+
+    python query_plans.py [path/to/bank.db]
+
+Runs the account lookups, transaction listing and history checks against
+the database, or against a small generated one if no path is given,
+records every SELECT they issue and prints SQLite's EXPLAIN QUERY PLAN
+for each. A query that scans the account or transaction table instead of
+searching one of its indexes fails the check, and the script exits with
+status 1. Nothing is written to the database.
+"""
+
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+from decimal import Decimal
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.orm.session import sessionmaker
+
+from account import Account, CheckingAccount, SavingsAccount
+from bank import Bank
+from migrate import SCHEMA_VERSION, prepare, schema_version
+
+TABLES = ("account", "transaction")
+
+
+def _sample(url):
+    """Fill a new database with a few accounts and transactions."""
+    engine = sqlalchemy.create_engine(url)
+    prepare(engine)
+    session = sessionmaker(bind=engine)()
+    bank = Bank()
+    session.add(bank)
+    start = datetime.date(2024, 1, 1)
+    for i in range(20):
+        account = bank.new_account("savings" if i % 2 else "checking", session)
+        account.latest_date = start
+        # ten days apart, well inside the savings limits
+        for day in range(0, 90, 10):
+            account.add_transaction(Decimal(10 + day), start + datetime.timedelta(days=day), session)
+    session.commit()
+    session.close()
+    engine.dispose()
+
+
+def hot_queries(bank, checking, savings, session):
+    """The operations checked, as (name, callable) pairs."""
+    date = checking.latest_date
+
+    def list_transactions():
+        page = checking.transactions_page(session, None, 5)
+        if page:
+            checking.transactions_page(session, page[-1], 5)
+
+    def savings_limits():
+        savings._check_limits(Decimal(1), savings.latest_date)
+
+    operations = [
+        ("find account", lambda: bank.find_account(checking.get_id(), session)),
+        ("accounts of a bank", bank.all_accounts),
+        ("list transactions", list_transactions),
+        ("interest applied", lambda: checking.interest_applied(date, session)),
+        ("balance as of", lambda: checking.balance_as_of(date, session)),
+        ("balances as of", lambda: bank.balances_as_of(date, session)),
+    ]
+    if savings is not None:
+        operations.append(("savings limit counts", savings_limits))
+    return operations
+
+
+def check(url):
+    """Print the plan of every query the hot operations issue. Returns the
+    names of the operations that scanned a table."""
+    engine = sqlalchemy.create_engine(url)
+    session = sessionmaker(bind=engine)()
+    bank = session.query(Bank).first()
+    if bank is None or not bank.all_accounts():
+        sys.exit("the database has no accounts to check")
+    checking = session.query(CheckingAccount).filter(Account._bank_id == bank._id).first()
+    savings = session.query(SavingsAccount).filter(Account._bank_id == bank._id).first()
+    if checking is None:
+        checking = savings
+
+    statements = []
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    failed = []
+    for name, operation in hot_queries(bank, checking, savings, session):
+        session.expire_all()
+        bank._index = None
+        statements.clear()
+        operation()
+        recorded = list(statements)
+
+        print(f"{name}:")
+        for statement, parameters in recorded:
+            with engine.connect() as conn:
+                plan = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).all()
+            for row in plan:
+                detail = row[-1]
+                scan = detail.startswith("SCAN") and detail.split()[1].strip('"') in TABLES
+                if scan and name not in failed:
+                    failed.append(name)
+                print(f"    {'SCAN!' if scan else 'ok':>5}  {detail}")
+        session.rollback()
+
+    session.close()
+    engine.dispose()
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the hot queries of the bank use indexes.")
+    parser.add_argument("database", nargs="?", help="a bank database; a small sample one by default")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.database:
+            url = f"sqlite:///{args.database}"
+        else:
+            url = f"sqlite:///{os.path.join(directory, 'bank.db')}"
+            _sample(url)
+        engine = sqlalchemy.create_engine(url)
+        with engine.connect() as conn:
+            version = schema_version(conn)
+        engine.dispose()
+        failed = check(url)
+
+    if failed:
+        print(f"full table scans in: {', '.join(failed)}")
+        if version < SCHEMA_VERSION:
+            print(f"schema version {version} predates some indexes; open the bank once to migrate it to {SCHEMA_VERSION}")
+        sys.exit(1)
+    print("every hot query uses an index")
+
+
+if __name__ == "__main__":
+    main()
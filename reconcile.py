@@ -0,0 +1,150 @@
+"""Check the invariants that tie the accounts to their transactions.
+
+For every account:
+
+    balance      the stored balance is the sum of its transaction amounts
+    latest_date  the stored latest date is that of its newest transaction
+    day_limit    a savings account has at most 2 transactions a day and
+    month_limit  at most 5 a month, interest and fees not counted
+    interest     interest was applied at most once a month
+
+Unlike replay.verify, nothing is taken from checkpoints: everything is
+recomputed from the whole log. Each account id range is read in one
+statement, account by account along the (account, date) index, so no
+rows are sorted and memory stays bounded by one account's history. SQLite
+sums the amounts and finds the newest date; the months that had interest
+and the days of savings transactions come back as strings, and once
+sorted the limits are checked by comparing neighbours. The ranges are
+spread over a pool of worker processes.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+
+import sqlalchemy
+from sqlalchemy import func, text
+
+from account import Account, CheckingAccount
+from workers import id_ranges
+
+# the limits SavingsAccount._check_limits enforces
+DAY_LIMIT = 2
+MONTH_LIMIT = 5
+
+# fees are the month-end rows of the low balance fee amount on checking
+# accounts; every other month-end row is interest
+_ACCOUNTS = text("""
+    SELECT a._id, a.type, a._balance, a.latest_date,
+           coalesce(sum(t._amount), 0), max(t._creation_date), count(t._id),
+           group_concat(CASE WHEN t._interest_flag = 1
+                              AND NOT (a.type = 'Checking' AND t._amount = :fee)
+                             THEN substr(t._creation_date, 1, 7) END, ' '),
+           group_concat(CASE WHEN t._interest_flag = 0 AND a.type = 'Savings'
+                             THEN t._creation_date END, ' ')
+    FROM account AS a
+    LEFT JOIN "transaction" AS t ON t._account_id = a._id
+    WHERE a._id BETWEEN :first AND :last
+    GROUP BY a._id
+""")
+
+
+class Discrepancy:
+    """An account that breaks one of the invariants."""
+
+    def __init__(self, check, account_id, detail):
+        self.check = check
+        self.account_id = account_id
+        self.detail = detail
+
+    def __str__(self):
+        return f"{self.check:<12}#{self.account_id:09}  {self.detail}"
+
+
+def _repeats(values, apart):
+    """The values that occur more than apart times in a row of the sorted list."""
+    return sorted({a for a, b in zip(values, values[apart:]) if a == b})
+
+
+def _money(cents):
+    return f"${Decimal(cents).scaleb(-2):,.2f}"
+
+
+def check_range(conn, first_id, last_id):
+    """Check the accounts with ids in [first_id, last_id]. Returns the
+    number of accounts and transactions checked and a list of
+    Discrepancy, in account id order."""
+    fee = int(CheckingAccount._low_balance_fee.scaleb(2))
+    accounts = transactions = 0
+    found = []
+    rows = conn.execute(_ACCOUNTS, {"first": first_id, "last": last_id, "fee": fee})
+    for account_id, kind, balance, latest, total, newest, count, interest, dates in rows:
+        accounts += 1
+        transactions += count
+        if balance != total:
+            found.append(Discrepancy("balance", account_id,
+                                     f"stored {_money(balance)}, transactions sum to {_money(total)}"))
+        if newest is not None and latest != newest:
+            found.append(Discrepancy("latest_date", account_id,
+                                     f"stored {latest}, newest transaction {newest}"))
+        if interest:
+            months = sorted(interest.split(" "))
+            for month in _repeats(months, 1):
+                found.append(Discrepancy("interest", account_id,
+                                         f"{month}: interest applied {months.count(month)} times"))
+        if dates:
+            days = sorted(dates.split(" "))
+            for day in _repeats(days, DAY_LIMIT):
+                found.append(Discrepancy("day_limit", account_id,
+                                         f"{day}: {days.count(day)} transactions, limit {DAY_LIMIT}"))
+            months = [day[:7] for day in days]
+            for month in _repeats(months, MONTH_LIMIT):
+                found.append(Discrepancy("month_limit", account_id,
+                                         f"{month}: {months.count(month)} transactions, limit {MONTH_LIMIT}"))
+    return accounts, transactions, found
+
+
+def _check_range(url, first_id, last_id):
+    """Worker process entry point: check one id range on its own engine."""
+    engine = sqlalchemy.create_engine(url)
+    try:
+        with engine.connect() as conn:
+            return check_range(conn, first_id, last_id)
+    finally:
+        engine.dispose()
+
+
+def reconcile(url, workers=1):
+    """Check every account of the database at url, the id range split over
+    workers processes. Returns the number of accounts and transactions
+    checked and the discrepancies in account id order. Each range is read
+    from its own snapshot, so writes made meanwhile may be seen by some
+    ranges and not others, but never by half of an account."""
+    engine = sqlalchemy.create_engine(url)
+    with engine.connect() as conn:
+        low, high = conn.execute(sqlalchemy.select(func.min(Account._id), func.max(Account._id))).one()
+    engine.dispose()
+    if low is None:
+        return 0, 0, []
+
+    ranges = id_ranges(low, high, workers)
+    if len(ranges) == 1:
+        return _check_range(url, low, high)
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(_check_range, url, first, last) for first, last in ranges]
+        results = [future.result() for future in futures]
+    return (sum(r[0] for r in results), sum(r[1] for r in results),
+            [discrepancy for r in results for discrepancy in r[2]])
+
+
+def write_report(out, accounts, transactions, discrepancies):
+    """Write a summary line, the count per check and one line per
+    discrepancy to the text file out."""
+    out.write(f"# {accounts} accounts, {transactions} transactions, "
+              f"{len(discrepancies)} discrepancies\n")
+    counts = {}
+    for discrepancy in discrepancies:
+        counts[discrepancy.check] = counts.get(discrepancy.check, 0) + 1
+    for check, count in sorted(counts.items()):
+        out.write(f"# {check}: {count}\n")
+    for discrepancy in discrepancies:
+        out.write(f"{discrepancy}\n")
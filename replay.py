@@ -0,0 +1,183 @@
+"""Rebuild account balances and latest dates from the transaction log.
+
+An account's balance is the sum of its transaction amounts and its
+latest date the latest of their dates, so both can be recomputed from the
+log alone and compared with the stored columns. The replayed state of
+each account is kept in ledger_checkpoint, and replay_mark records the
+last transaction id folded into it. Transaction ids only grow, so
+replay() picks up where the mark left off and reads only the
+transactions written since.
+
+A replay walks the log in transaction id order, which is the table's
+own order, chunk_size ids at a time. Each chunk is summed per account by
+SQLite and added to the checkpoints in the same transaction that moves
+the mark, so memory is bounded by one chunk's accounts however long the
+log is, and an interrupted replay resumes from the last committed chunk.
+"""
+
+import datetime
+from decimal import Decimal
+
+import sqlalchemy
+from sqlalchemy import Column, DATE, ForeignKey, Integer, func, text
+
+from money import FixedPoint
+from transaction import Base, Transaction
+import account  # registers the account table the checkpoints refer to
+
+
+class Checkpoint(Base):
+    """An account's balance and latest date as replayed from the log."""
+
+    __tablename__ = "ledger_checkpoint"
+
+    _account_id = Column(Integer, ForeignKey("account._id"), primary_key=True)
+    _balance = Column(FixedPoint(2))
+    latest_date = Column(DATE)
+
+
+class ReplayMark(Base):
+    """The last transaction id folded into the checkpoints, in row 1."""
+
+    __tablename__ = "replay_mark"
+
+    _id = Column(Integer, primary_key=True)
+    _through = Column(Integer)
+
+
+# NOT INDEXED keeps SQLite on the rowid range instead of walking the
+# whole (account, date) index to produce the groups in order
+_FOLD = text("""
+    INSERT INTO ledger_checkpoint (_account_id, _balance, latest_date)
+    SELECT _account_id, SUM(_amount), MAX(_creation_date)
+    FROM "transaction" NOT INDEXED
+    WHERE _id > :after AND _id <= :through
+    GROUP BY _account_id
+    ON CONFLICT (_account_id) DO UPDATE SET
+        _balance = _balance + excluded._balance,
+        latest_date = max(latest_date, excluded.latest_date)
+""")
+
+_COUNT = text('SELECT count(*) FROM "transaction" WHERE _id > :after AND _id <= :through')
+
+_SET_MARK = text("""
+    INSERT INTO replay_mark (_id, _through) VALUES (1, :through)
+    ON CONFLICT (_id) DO UPDATE SET _through = excluded._through
+""")
+
+# stored state against the checkpoints plus whatever was written after
+# the mark, in one statement so it all comes from one snapshot
+_DRIFT = text("""
+    SELECT a._id, a._balance, a.latest_date,
+           coalesce(c._balance, 0) + coalesce(d.amount, 0) AS balance,
+           coalesce(max(c.latest_date, d.latest_date), c.latest_date, d.latest_date) AS replayed_date
+    FROM account AS a
+    LEFT JOIN ledger_checkpoint AS c ON c._account_id = a._id
+    LEFT JOIN (
+        SELECT _account_id, SUM(_amount) AS amount, MAX(_creation_date) AS latest_date
+        FROM "transaction" NOT INDEXED
+        WHERE _id > :after
+        GROUP BY _account_id
+    ) AS d ON d._account_id = a._id
+    WHERE a._balance != balance
+       OR (replayed_date IS NOT NULL AND a.latest_date != replayed_date)
+    ORDER BY a._id
+""")
+
+_REPAIR = text("""
+    UPDATE account SET
+        _balance = coalesce((SELECT c._balance FROM ledger_checkpoint AS c
+                             WHERE c._account_id = account._id), 0),
+        latest_date = coalesce((SELECT c.latest_date FROM ledger_checkpoint AS c
+                                WHERE c._account_id = account._id), latest_date)
+    WHERE _id IN (
+        SELECT a._id FROM account AS a
+        LEFT JOIN ledger_checkpoint AS c ON c._account_id = a._id
+        WHERE a._balance != coalesce(c._balance, 0)
+           OR (c.latest_date IS NOT NULL AND a.latest_date != c.latest_date))
+""")
+
+
+class Drift:
+    """An account whose stored balance or latest date differs from the replay."""
+
+    def __init__(self, account_id, balance, replayed_balance, latest_date, replayed_date):
+        self.account_id = account_id
+        self.balance = balance
+        self.replayed_balance = replayed_balance
+        self.latest_date = latest_date
+        self.replayed_date = replayed_date
+
+    def __str__(self):
+        parts = []
+        if self.balance != self.replayed_balance:
+            parts.append(f"balance ${self.balance:,.2f}, replayed ${self.replayed_balance:,.2f}")
+        if self.replayed_date is not None and self.latest_date != self.replayed_date:
+            parts.append(f"latest date {self.latest_date}, replayed {self.replayed_date}")
+        return f"#{self.account_id:09}: " + "; ".join(parts)
+
+
+def mark(conn):
+    """The last transaction id folded into the checkpoints."""
+    through = conn.execute(sqlalchemy.select(ReplayMark._through).where(ReplayMark._id == 1)).scalar()
+    return through or 0
+
+
+def _fold(conn, after, through):
+    """Add the transactions with ids in (after, through] to the checkpoints
+    and move the mark. Returns how many there were."""
+    params = {"after": after, "through": through}
+    count = conn.execute(_COUNT, params).scalar()
+    conn.execute(_FOLD, params)
+    conn.execute(_SET_MARK, params)
+    return count
+
+
+def replay(engine, chunk_size=1_000_000, full=False, progress=None):
+    """Bring the checkpoints up to the newest transaction, committing every
+    chunk_size transaction ids. With full the checkpoints are dropped first
+    and the whole log is replayed. progress, if given, is called with the
+    mark after each chunk. Returns the number of transactions replayed."""
+    with engine.begin() as conn:
+        if full:
+            conn.execute(Checkpoint.__table__.delete())
+            conn.execute(ReplayMark.__table__.delete())
+        after = mark(conn)
+        newest = conn.execute(sqlalchemy.select(func.max(Transaction._id))).scalar() or 0
+
+    replayed = 0
+    while after < newest:
+        through = min(after + chunk_size, newest)
+        with engine.begin() as conn:
+            replayed += _fold(conn, after, through)
+        after = through
+        if progress is not None:
+            progress(after)
+    return replayed
+
+
+def verify(conn):
+    """Yields a Drift for every account whose stored balance or latest date
+    differs from the replayed one, in id order. Transactions written after
+    the mark are replayed on the fly, so the checkpoints need not be
+    current. An account with no transactions should have a zero balance;
+    its latest date is not checked, since only the log is replayed."""
+    for account_id, balance, date, replayed, replayed_date in conn.execute(_DRIFT, {"after": mark(conn)}):
+        yield Drift(account_id, Decimal(balance).scaleb(-2), Decimal(replayed).scaleb(-2),
+                    datetime.date.fromisoformat(date) if date else None,
+                    datetime.date.fromisoformat(replayed_date) if replayed_date else None)
+
+
+def repair(engine, chunk_size=1_000_000):
+    """Replay the log and overwrite every drifted account's balance and
+    latest date with the replayed ones. The last chunk and the repair
+    share one transaction, so on an engine from db.create_engine(...,
+    concurrent=True) no write can slip in between. Returns the number of
+    accounts repaired."""
+    replay(engine, chunk_size)
+    with engine.begin() as conn:
+        after = mark(conn)
+        newest = conn.execute(sqlalchemy.select(func.max(Transaction._id))).scalar() or 0
+        if newest > after:
+            _fold(conn, after, newest)
+        return conn.execute(_REPAIR).rowcount
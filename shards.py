@@ -0,0 +1,191 @@
+"""The accounts of one bank spread over several database files.
+
+    bank = ShardedBank(shard_urls("bank.db", 4))   # bank-0.db ... bank-3.db
+    account = bank.new_account("checking")
+    db.begin_write(bank.session_for(account))
+    account.add_transaction(Decimal(50), datetime.date.today(), bank.session_for(account))
+    bank.commit()
+
+Shard k holds the accounts with ids k * SHARD_SPAN + 1 through
+(k + 1) * SHARD_SPAN: its account table's AUTOINCREMENT counter starts
+at k * SHARD_SPAN, so ids stay unique across the bank and an account's
+shard follows from its id alone. An account and its transactions never
+span shards. Each shard has its own engine, session and Bank row, so
+writes to different shards take different write locks and go ahead in
+parallel. New accounts are dealt to the shards in turn.
+
+Whole-bank work fans out to every shard at once: commits and summaries
+on a thread per shard, and month-end on a process per shard.
+"""
+
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from sqlalchemy import text
+from sqlalchemy.orm.session import sessionmaker
+
+from bank import Bank
+from migrate import prepare
+from month_end import run_month_end, run_month_end_vectorized
+import db
+from workers import worker
+
+# accounts per shard; ids keep their nine digits up to nine shards
+SHARD_SPAN = 10 ** 8
+
+
+def shard_urls(path, shards):
+    """The URLs of shards database files named after path, e.g.
+    bank-0.db and bank-1.db for bank.db."""
+    base, extension = os.path.splitext(path)
+    return [f"sqlite:///{base}-{k}{extension}" for k in range(shards)]
+
+
+class Shard:
+    """One database file of a ShardedBank, with its own engine, session
+    and Bank."""
+
+    def __init__(self, index, url):
+        self.index = index
+        self.url = url
+        self.first_id = index * SHARD_SPAN + 1
+        self.last_id = (index + 1) * SHARD_SPAN
+        self.engine = db.create_engine(url, concurrent=True)
+        prepare(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        db.begin_write(self.session)
+        self._claim_ids()
+
+        self.bank = self.session.query(Bank).first()
+        if not self.bank:
+            self.bank = Bank()
+            self.session.add(self.bank)
+        self.session.commit()
+
+    def _claim_ids(self):
+        """Start the account id counter at the shard's range, or check that
+        the accounts already in the file belong to it."""
+        low, high = self.session.execute(text("SELECT min(_id), max(_id) FROM account")).one()
+        if low is not None and (low < self.first_id or high > self.last_id):
+            raise ValueError(f"{self.url} has accounts {low} to {high}, outside shard {self.index}")
+        self.session.execute(text(
+            "INSERT INTO sqlite_sequence (name, seq) SELECT 'account', 0 "
+            "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'account')"))
+        self.session.execute(text(
+            "UPDATE sqlite_sequence SET seq = :start WHERE name = 'account' AND seq < :start"),
+            {"start": self.first_id - 1})
+
+    def owns(self, account_id):
+        return self.first_id <= account_id <= self.last_id
+
+
+@worker
+def _month_end_shard(url, chunk_size, vectorized):
+    """Worker process entry point: month-end on one shard."""
+    engine = db.create_engine(url, concurrent=True)
+    session = sessionmaker(bind=engine)()
+    try:
+        bank_id = session.query(Bank._id).scalar()
+        if vectorized:
+            return run_month_end_vectorized(session, bank_id, chunk_size)
+        return run_month_end(session, bank_id, chunk_size)
+    finally:
+        session.close()
+        engine.dispose()
+
+
+class ShardedBank:
+    """The Bank interface over a list of shard URLs, in shard order.
+
+    Accounts are used as usual, with the session of their own shard:
+    see session_for. commit() and rollback() apply to every shard."""
+
+    def __init__(self, urls):
+        self._shards = [Shard(index, url) for index, url in enumerate(urls)]
+        self._turn = itertools.cycle(self._shards)
+        self._threads = ThreadPoolExecutor(len(self._shards))
+
+    @property
+    def shards(self):
+        return list(self._shards)
+
+    def shard(self, account_id):
+        """The shard that holds account_id, or None if no shard would."""
+        index = (int(account_id) - 1) // SHARD_SPAN
+        if 0 <= index < len(self._shards):
+            return self._shards[index]
+        return None
+
+    def session_for(self, account):
+        """The session of the account's shard, to pass to its methods."""
+        return self.shard(account.get_id()).session
+
+    def find_account(self, account_id):
+        """Locate the account with the given id on its shard."""
+        shard = self.shard(account_id)
+        if shard is None:
+            return None
+        return shard.bank.find_account(account_id, shard.session)
+
+    def new_account(self, account_type, shard=None, ids=None):
+        """Open an account on the given shard, or on the next one in turn.
+        ids, if given, must be an IdAllocator on that shard's session.
+        Raises ValueError, and rolls back the shard's session, once the
+        shard has used up its SHARD_SPAN ids, since an id past them would
+        be looked up on the next shard."""
+        shard = shard or next(self._turn)
+        db.begin_write(shard.session)
+        account = shard.bank.new_account(account_type, shard.session, ids)
+        if not shard.owns(account.get_id()):
+            shard.session.rollback()
+            raise(ValueError(f"shard {shard.index} ({shard.url}) has no account ids left"))
+        return account
+
+    def all_accounts(self):
+        """Every account of every shard, loaded from all shards at once."""
+        loaded = self._fan_out(lambda shard: sorted(shard.bank.all_accounts(), key=lambda a: a.get_id()))
+        return [account for accounts in loaded for account in accounts]
+
+    def summaries(self):
+        """Refresh every shard's SummaryCache at once and return the
+        (account id, summary line) pairs of the whole bank in id order."""
+        def refresh(shard):
+            summaries = shard.bank.summaries()
+            summaries.refresh(shard.session)
+            return [(account_id, summaries.line(account_id)) for account_id in summaries.ids()]
+        return [line for lines in self._fan_out(refresh) for line in lines]
+
+    def commit(self):
+        """Commit every shard, all at once. Each shard commits on its own,
+        so after a failure some shards may have committed and others not."""
+        self._fan_out(lambda shard: shard.session.commit())
+
+    def rollback(self):
+        self._fan_out(lambda shard: shard.session.rollback())
+
+    def run_month_end(self, chunk_size=1000, vectorized=False):
+        """Assess month-end interest and fees on every shard, a process per
+        shard. Pending writes are committed first. Returns the total
+        accounts assessed and skipped."""
+        self.commit()
+        with ProcessPoolExecutor(len(self._shards)) as pool:
+            futures = [pool.submit(_month_end_shard, shard.url, chunk_size, vectorized)
+                       for shard in self._shards]
+            results = [future.result() for future in futures]
+        for shard in self._shards:
+            shard.session.expire_all()
+            if shard.bank._summaries is not None:
+                shard.bank._summaries.clear()
+        return sum(r[0] for r in results), sum(r[1] for r in results)
+
+    def close(self):
+        self._threads.shutdown()
+        for shard in self._shards:
+            shard.session.close()
+            shard.engine.dispose()
+
+    def _fan_out(self, work):
+        """Run work(shard) for every shard on the thread pool and return the
+        results in shard order; the first error is raised."""
+        return list(self._threads.map(work, self._shards))
@@ -0,0 +1,176 @@
+"""Write month-end statements for every account in bank.db.
+
+    python statements.py YYYY-MM [--out DIR] [--workers N]
+
+Each statement has the opening balance, the month's transactions with the
+balance after each, interest and fee lines, and the closing balance. The
+month's transactions are streamed in a single pass in (account, date)
+order, alongside a second cursor over the accounts that reads each opening
+balance from the running balance of the account's last earlier
+transaction, so no ORM objects are built and memory does not grow with
+the bank. Statements go through a buffered writer to one file per worker;
+with --workers the account ids are split into ranges written by a pool
+of processes.
+"""
+
+import argparse
+import datetime
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import sqlalchemy
+from sqlalchemy import BigInteger, String, func, type_coerce
+
+from account import Account, CheckingAccount
+from bank import Bank
+from migrate import prepare
+from transaction import Transaction
+import banklog
+from workers import id_ranges
+
+
+def _money(cents):
+    """Formats cents like the rest of the bank, e.g. $1,234.50 or $-10.00.
+    A double holds any balance below $90 trillion to well within a cent,
+    so formatting it is exact and much cheaper than a Decimal."""
+    return f"${cents / 100:,.2f}"
+
+
+def _month(year, month):
+    """The first and last days of the month as ISO dates."""
+    first = datetime.date(year, month, 1)
+    last = (first + datetime.timedelta(days=31)).replace(day=1) - datetime.timedelta(days=1)
+    return first.isoformat(), last.isoformat()
+
+
+def write_statements(conn, bank_id, year, month, out, first_id=None, last_id=None, chunk_size=10_000):
+    """Write the statements of the bank's accounts with ids in
+    [first_id, last_id] to the text file out. Returns how many were written."""
+    start, end = _month(year, month)
+    fee = int(CheckingAccount._low_balance_fee.scaleb(2))
+    accounts = Account.__table__
+    transactions = Transaction.__table__
+
+    opening = sqlalchemy.select(type_coerce(transactions.c._balance_after, BigInteger)).where(
+        transactions.c._account_id == accounts.c._id,
+        transactions.c._creation_date < start).order_by(
+        transactions.c._creation_date.desc(), transactions.c._id.desc()).limit(1)
+    account_query = sqlalchemy.select(
+        accounts.c._id, accounts.c.type, opening.scalar_subquery(),
+    ).where(accounts.c._bank_id == bank_id).order_by(accounts.c._id)
+
+    # dates and money are read as stored, so nothing is parsed
+    transaction_query = sqlalchemy.select(
+        transactions.c._account_id,
+        type_coerce(transactions.c._creation_date, String),
+        type_coerce(transactions.c._amount, BigInteger),
+        transactions.c._interest_flag,
+        type_coerce(transactions.c._balance_after, BigInteger),
+    ).where(
+        transactions.c._creation_date >= start, transactions.c._creation_date <= end,
+    ).order_by(transactions.c._account_id, transactions.c._creation_date, transactions.c._id)
+
+    if first_id is not None:
+        account_query = account_query.where(accounts.c._id >= first_id)
+        transaction_query = transaction_query.where(transactions.c._account_id >= first_id)
+    if last_id is not None:
+        account_query = account_query.where(accounts.c._id <= last_id)
+        transaction_query = transaction_query.where(transactions.c._account_id <= last_id)
+
+    streamed = conn.execution_options(yield_per=chunk_size)
+    rows = itertools.chain.from_iterable(streamed.execute(transaction_query).partitions())
+    row = next(rows, None)
+    written = 0
+    for account_id, account_type, balance in streamed.execute(account_query):
+        # skip transactions of accounts outside the bank
+        while row is not None and row[0] < account_id:
+            row = next(rows, None)
+
+        balance = balance or 0
+        lines = [f"{account_type}#{account_id:09}  statement for {start[:7]}\n",
+                 f"{start}  {'opening balance':<16}{'':>16}{_money(balance):>16}\n"]
+        while row is not None and row[0] == account_id:
+            _, date, amount, flag, balance = row
+            if flag:
+                # fees are the low balance fee on checking accounts, as in
+                # reconcile; interest on an overdrawn account is negative too
+                kind = "fee" if account_type == "Checking" and amount == fee else "interest"
+            else:
+                kind = "deposit" if amount >= 0 else "withdrawal"
+            lines.append(f"{date}  {kind:<16}{_money(amount):>16}{_money(balance):>16}\n")
+            row = next(rows, None)
+        lines.append(f"{end}  {'closing balance':<16}{'':>16}{_money(balance):>16}\n\n")
+        out.write("".join(lines))
+        written += 1
+    return written
+
+
+def _statement_file(directory, year, month, part=None):
+    name = f"statements-{year}-{month:02}" + (f"-{part:03}" if part is not None else "") + ".txt"
+    return os.path.join(directory, name)
+
+
+def _write_range(url, bank_id, year, month, filename, first_id, last_id):
+    """Worker process entry point: write one id range to its own file."""
+    engine = sqlalchemy.create_engine(url)
+    try:
+        with engine.connect() as conn, open(filename, "w", buffering=1 << 20) as out:
+            return write_statements(conn, bank_id, year, month, out, first_id, last_id)
+    finally:
+        engine.dispose()
+
+
+def write_statements_parallel(url, bank_id, year, month, directory, workers):
+    """Split the bank's account ids into one range per worker and write
+    each range's statements to its own file in a process pool.
+    Returns the number of statements and the files written."""
+    engine = sqlalchemy.create_engine(url)
+    with engine.connect() as conn:
+        low, high = conn.execute(
+            sqlalchemy.select(func.min(Account._id), func.max(Account._id))
+            .where(Account._bank_id == bank_id)).one()
+    engine.dispose()
+    if low is None:
+        return 0, []
+
+    ranges = id_ranges(low, high, workers)
+    files = [_statement_file(directory, year, month, part) for part in range(len(ranges))]
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(_write_range, url, bank_id, year, month, filename, first, last)
+                   for filename, (first, last) in zip(files, ranges)]
+        written = sum(future.result() for future in futures)
+    return written, files
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write month-end statements for every account.")
+    parser.add_argument("month", type=lambda s: datetime.datetime.strptime(s, "%Y-%m"),
+                        help="the statement month, as YYYY-MM")
+    parser.add_argument("--out", default=".", help="directory for the statement files")
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    banklog.configure()
+    url = f"sqlite:///bank.db"
+    engine = sqlalchemy.create_engine(url)
+    prepare(engine)
+    with engine.connect() as conn:
+        bank_id = conn.execute(sqlalchemy.select(Bank._id).limit(1)).scalar()
+    engine.dispose()
+    if bank_id is None:
+        print("bank.db has no accounts")
+        return
+
+    year, month = args.month.year, args.month.month
+    os.makedirs(args.out, exist_ok=True)
+    if args.workers > 1:
+        written, files = write_statements_parallel(url, bank_id, year, month, args.out, args.workers)
+    else:
+        files = [_statement_file(args.out, year, month)]
+        written = _write_range(url, bank_id, year, month, files[0], None, None)
+    print(f"statements: {written}, in {', '.join(files)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Formatted account summaries, cached per account.
+
+A Bank's SummaryCache keeps each account's summary line and balance.
+Account writes (add_transaction, assess_interest_and_fees and the fees)
+and Bank.new_account invalidate the entries of the accounts they touch,
+and refresh() reloads only those, so redrawing a summary after a few
+transactions costs a few accounts rather than the whole bank. Writes
+committed by other connections, e.g. other tellers sharing bank.db, are
+noticed through SQLite's PRAGMA data_version, and the next refresh then
+reloads every entry.
+"""
+
+from account import Account
+
+
+class SummaryCache:
+    """Summary line and balance per account id, for the accounts of one bank."""
+
+    def __init__(self, bank):
+        self._bank = bank
+        self._entries = {}  # account id -> (line, balance)
+        self._complete = False
+        self._stale = set()
+        self._version = None  # (connection, data_version) at the last refresh
+
+    def invalidate(self, account_id):
+        """Mark the account's entry as out of date."""
+        self._stale.add(account_id)
+
+    def clear(self):
+        """Drop every entry, so the next refresh reloads the whole bank."""
+        self._entries = {}
+        self._complete = False
+        self._stale.clear()
+
+    def refresh(self, session, load_all=True):
+        """Bring the cache up to date and return the ids whose entries
+        changed, in id order. The first refresh loads every account, unless
+        load_all is False; then only invalidated accounts are ever loaded,
+        for views that fetch the other rows themselves."""
+        self._check_version(session)
+        if load_all and not self._complete:
+            accounts = self._bank.all_accounts()
+            self._complete = True
+        else:
+            accounts = [session.get(Account, account_id) for account_id in self._stale]
+        self._stale.clear()
+
+        changed = []
+        for account in accounts:
+            if account is None:
+                continue
+            self._entries[account.get_id()] = (str(account), account._balance)
+            changed.append(account.get_id())
+        return sorted(changed)
+
+    def _check_version(self, session):
+        """Mark every entry stale if another connection has committed since
+        the last refresh. data_version only compares within a connection,
+        so a refresh on a different connection counts as a change too."""
+        conn = session.connection()
+        version = (id(conn.connection.dbapi_connection),
+                   conn.exec_driver_sql("PRAGMA data_version").scalar())
+        if version != self._version:
+            self._version = version
+            self._stale.update(self._entries)
+            self._complete = False
+
+    def ids(self):
+        """The ids of the cached accounts in id order."""
+        return sorted(self._entries)
+
+    def line(self, account_id):
+        return self._entries[account_id][0]
+
+    def balance(self, account_id):
+        return self._entries[account_id][1]
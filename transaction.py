@@ -3,8 +3,10 @@ from decimal import *
 
 getcontext().rounding = ROUND_HALF_UP
 
-from sqlalchemy import Column, Integer, ForeignKey, DATE, Float
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import Column, Integer, ForeignKey, DATE, Index
+from sqlalchemy.orm import declarative_base
+
+from money import FixedPoint
 
 Base = declarative_base()
 
@@ -16,13 +18,21 @@ class Transaction(Base):
     _account_id = Column(Integer, ForeignKey("account._id"))
 
     _creation_date = Column(DATE)
-    _amount = Column(Float(asdecimal=True))
+    _amount = Column(FixedPoint(2))
     _interest_flag = Column(Integer)
 
-    def __init__(self, amount, date = datetime.date.today(), i_flag = 0):
+    # the account balance right after this transaction
+    _balance_after = Column(FixedPoint(2))
+
+    __table_args__ = (
+        Index("ix_transaction_account_date", "_account_id", "_creation_date"),
+    )
+
+    def __init__(self, amount, date = datetime.date.today(), i_flag = 0, balance_after = None):
         self._creation_date = date
         self._amount = Decimal(amount)
         self._interest_flag = i_flag
+        self._balance_after = balance_after
     
     def __lt__(self, other):
         return self._creation_date < other._creation_date
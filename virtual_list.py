@@ -0,0 +1,205 @@
+"""A Tk list that only holds the rows in view.
+
+A VirtualList shows the rows of a source, an object with two methods that
+run on a PageLoader's background thread, with that thread's own session:
+
+    count(session) -> the number of rows
+    page(session, offset, after, limit) -> up to limit (key, text, colour)
+        rows starting at offset; after is the key of the row just before
+        offset when it is known, so the source can seek along its index
+        instead of skipping offset rows
+
+The Listbox never has more than height items. Pages are fetched as the
+view scrolls onto them and the most recently used ones are kept.
+"""
+
+from collections import OrderedDict
+import logging
+import queue
+import threading
+import tkinter as tk
+
+
+class PageLoader:
+    """Runs queries on a daemon thread and hands each result back to the
+    Tk thread, which polls for them with after()."""
+
+    def __init__(self, window, Session, poll_ms=20):
+        self._window = window
+        self._poll_ms = poll_ms
+        self._requests = queue.SimpleQueue()
+        self._results = queue.SimpleQueue()
+        threading.Thread(target=self._run, args=(Session,), daemon=True).start()
+        self._poll()
+
+    def submit(self, work, done):
+        """Call work(session) on the loader thread and then done(result)
+        on the Tk thread. An error from work is raised on the Tk thread."""
+        self._requests.put((work, done))
+
+    def _run(self, Session):
+        session = Session()
+        while True:
+            work, done = self._requests.get()
+            try:
+                result, error = work(session), None
+            except Exception as e:
+                logging.error("%s: %r", type(e).__name__, str(e))
+                result, error = None, e
+            # end the read transaction so writers are not held up
+            session.rollback()
+            self._results.put((done, result, error))
+
+    def _poll(self):
+        try:
+            while True:
+                done, result, error = self._results.get_nowait()
+                if error is not None:
+                    raise error
+                done(result)
+        except queue.Empty:
+            pass
+        finally:
+            self._window.after(self._poll_ms, self._poll)
+
+
+class VirtualList(tk.Frame):
+    """A scrolling list of a source's rows; command is called with the key
+    of a row when it is selected."""
+
+    def __init__(self, master, loader, height=20, width=40, page_size=100, cached_pages=50, command=None):
+        super().__init__(master)
+        self._loader = loader
+        self._height = height
+        self._page_size = page_size
+        self._cached_pages = cached_pages
+        self._command = command
+
+        self._source = None
+        self._generation = 0
+        self._count = 0
+        self._top = 0
+        self._pages = OrderedDict()  # page number -> rows
+        self._pending = set()
+        self._selected = None
+
+        self._list_box = tk.Listbox(self, height=height, width=width, activestyle="none", exportselection=False)
+        self._scrollbar = tk.Scrollbar(self, command=self._scroll)
+        self._list_box.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self._scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self._list_box.bind("<<ListboxSelect>>", self._select)
+        self._list_box.bind("<MouseWheel>", lambda e: self._move(-1 if e.delta > 0 else 1))
+        self._list_box.bind("<Button-4>", lambda e: self._move(-1))
+        self._list_box.bind("<Button-5>", lambda e: self._move(1))
+
+    def show(self, source):
+        """Replace the rows with those of source, scrolled to the top."""
+        self._source = source
+        self._top = 0
+        self._selected = None
+        self.reload()
+
+    def reload(self):
+        """Fetch the rows again, keeping the scroll position."""
+        self._generation += 1
+        self._pages.clear()
+        self._pending.clear()
+        generation = self._generation
+        self._loader.submit(self._source.count, lambda count: self._counted(generation, count))
+
+    def update_rows(self, rows):
+        """Replace the cached rows with the keys of rows, and pick up rows
+        added at the end since the count was taken."""
+        changed = {key: (key, text, colour) for key, text, colour in rows}
+        for page in self._pages.values():
+            for i, (key, _, _) in enumerate(page):
+                if key in changed:
+                    page[i] = changed[key]
+        generation = self._generation
+        self._loader.submit(self._source.count, lambda count: self._counted(generation, count))
+
+    def _counted(self, generation, count):
+        if generation != self._generation:
+            return
+        if count != self._count:
+            # the last page may have been short
+            for page in [p for p in self._pages if p >= self._count // self._page_size]:
+                del self._pages[page]
+            self._count = count
+        self._top = max(0, min(self._top, count - self._height))
+        self._render()
+
+    def _scroll(self, action, amount, unit=None):
+        if action == tk.MOVETO:
+            self._top = int(float(amount) * self._count)
+            self._move(0)
+        elif unit == tk.PAGES:
+            self._move(int(amount) * self._height)
+        else:
+            self._move(int(amount))
+
+    def _move(self, rows):
+        self._top = max(0, min(self._top + rows, self._count - self._height))
+        self._render()
+
+    def _render(self):
+        self._list_box.delete(0, tk.END)
+        end = min(self._top + self._height, self._count)
+        for i in range(self._top, end):
+            row = self._row(i)
+            if row is None:
+                self._list_box.insert(tk.END, "...")
+                continue
+            key, text, colour = row
+            self._list_box.insert(tk.END, text)
+            if colour:
+                self._list_box.itemconfig(tk.END, {"fg": colour})
+            if key == self._selected:
+                self._list_box.selection_set(tk.END)
+
+        if self._count:
+            self._scrollbar.set(self._top / self._count, end / self._count)
+        else:
+            self._scrollbar.set(0, 1)
+
+    def _row(self, i):
+        page, offset = divmod(i, self._page_size)
+        rows = self._pages.get(page)
+        if rows is None:
+            self._request(page)
+            return None
+        self._pages.move_to_end(page)
+        return rows[offset] if offset < len(rows) else None
+
+    def _request(self, page):
+        if page in self._pending:
+            return
+        self._pending.add(page)
+        previous = self._pages.get(page - 1)
+        after = previous[-1][0] if previous and len(previous) == self._page_size else None
+        source = self._source
+        generation = self._generation
+        offset = page * self._page_size
+        self._loader.submit(lambda session: source.page(session, offset, after, self._page_size),
+                            lambda rows: self._loaded(generation, page, rows))
+
+    def _loaded(self, generation, page, rows):
+        if generation != self._generation:
+            return
+        self._pending.discard(page)
+        self._pages[page] = rows
+        while len(self._pages) > self._cached_pages:
+            self._pages.popitem(last=False)
+        first = page * self._page_size
+        if first < self._top + self._height and first + len(rows) > self._top:
+            self._render()
+
+    def _select(self, event):
+        selection = self._list_box.curselection()
+        if not selection:
+            return
+        row = self._row(self._top + selection[0])
+        if row is not None:
+            self._selected = row[0]
+            if self._command:
+                self._command(row[0])
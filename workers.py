@@ -0,0 +1,32 @@
+"""Helpers for the jobs that spread accounts over a pool of worker processes.
+
+The account ids are split into contiguous ranges with id_ranges, one
+per worker, and each worker's entry point is decorated with worker so
+that it logs to bank.log like the parent process does.
+"""
+
+import functools
+
+import banklog
+
+
+def id_ranges(low, high, count):
+    """Split the ids from low to high into at most count contiguous
+    (first, last) ranges of about equal size, in id order."""
+    step = (high - low) // count + 1
+    return [(start, min(start + step - 1, high)) for start in range(low, high + 1, step)]
+
+
+def worker(fn):
+    """Decorator for a pool worker's entry point: logging is configured
+    in the worker process for the call and shut down afterwards, since
+    pool workers leave through os._exit, which skips atexit and so
+    would lose the records still queued."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        banklog.configure()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            banklog.shutdown()
+    return wrapper